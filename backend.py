@@ -1,7 +1,19 @@
 import pandas as pd
+import numpy as np
 import openpyxl
+import copy
 import json
+import logging
 import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from collections.abc import Mapping
+import metrics
+import tablecache
+
+logger = logging.getLogger(__name__)
 
 
 def import_tables(filepath):
@@ -15,80 +27,1067 @@ def import_tables(filepath):
         with open(filepath, "r") as fp:
             content = fp.read()
     except IOError:
-        print(f"{filepath} not found or is not readable.")
+        logger.error("%s not found or is not readable.", filepath)
         raise Exception(f"Configuration Problem: {filepath} was not readable.")
 
     raw_data = json.loads(content)
     return raw_data["table list"]
 
 
+# Longest run of digits that still fits in an int64.
+D100_MAX_DIGITS = 18
+POWERS_OF_TEN = 10 ** np.arange(D100_MAX_DIGITS, dtype=np.int64)
+# Bad D100 rows named in an error; any beyond these are only counted.
+REPORTED_ROWS = 10
+
+
+def parse_d100_fields(fields, rows=None) -> tuple:
+    """
+    This function transforms D100 strings into arrays of integers for Roll and
+    Max, parsing the whole column at once. Each D100 field is either a single
+    integer or two integers separated by a dash - or – character, with optional
+    spaces around them, and "00" is read as 100, as on a percentile die. It raises
+    a ValueError listing the worksheet rows whose fields cannot be read this way,
+    up to REPORTED_ROWS of them, taken from rows, or counted from the title row as
+    row 1 if rows is None.
+    The column is joined into one byte buffer and every character is classified
+    with numpy, so the cost per row is a handful of array operations rather than
+    Python string splitting.
+    :param fields: iterable of str
+    :param rows: list of int, the worksheet row of each field, or None
+    :return: tuple of (np.ndarray, np.ndarray)
+    """
+    fields = list(fields)
+    n = len(fields)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # Worksheet cells cannot hold a NUL character, so it is a safe separator.
+    # En dashes become hyphens and no-break spaces become spaces; anything else
+    # outside ASCII is left as bytes >= 128 that fail the checks below.
+    try:
+        text = "\0".join(fields) + "\0"
+    except TypeError:
+        text = "\0".join(f if isinstance(f, str) else "?" for f in fields) + "\0"
+    text = text.encode("utf-8")
+    text = text.replace("–".encode("utf-8"), b"-").replace("\xa0".encode("utf-8"), b" ")
+    buf = np.frombuffer(text, dtype=np.uint8)
+
+    is_digit = (buf >= ord("0")) & (buf <= ord("9"))
+    is_dash = buf == ord("-")
+    is_sep = buf == 0
+    is_other = ~(is_digit | is_dash | is_sep | (buf == ord(" ")) | (buf == ord("\t")))
+    separators = np.flatnonzero(is_sep)
+    dash_pos = np.flatnonzero(is_dash)
+    dash_line = np.searchsorted(separators, dash_pos)
+    bad = np.zeros(n, dtype=bool)
+    bad[np.searchsorted(separators, np.flatnonzero(is_other))] = True
+
+    # Every field needs exactly one run of digits, or two with a dash between.
+    starts = np.flatnonzero(is_digit & ~np.concatenate(([False], is_digit[:-1])))
+    ends = np.flatnonzero(is_digit & ~np.concatenate((is_digit[1:], [False])))
+    lengths = ends - starts + 1
+    run_line = np.searchsorted(separators, starts)
+    dashes = np.bincount(dash_line, minlength=n)
+    runs = np.bincount(run_line, minlength=n)
+    bad |= (dashes > 1) | (runs != dashes + 1)
+    bad[run_line[lengths > D100_MAX_DIGITS]] = True
+
+    first = np.minimum(np.searchsorted(run_line, np.arange(n)), len(starts) - 1)
+    line_dash = np.zeros(n, dtype=np.int64)
+    line_dash[dash_line] = dash_pos
+    ranged = (dashes == 1) & ~bad
+    second = np.minimum(first + 1, len(starts) - 1)
+    bad[ranged] = ~((ends[first[ranged]] < line_dash[ranged])
+                    & (line_dash[ranged] < starts[second[ranged]]))
+    if bad.any():
+        numbers = np.flatnonzero(bad) + 2 if rows is None else np.asarray(rows)[bad]
+        listed = ", ".join(map(str, numbers[:REPORTED_ROWS].tolist()))
+        if len(numbers) > REPORTED_ROWS:
+            listed += f" and {len(numbers) - REPORTED_ROWS} more"
+        raise ValueError(f"D100 fields in rows {listed} are not a single integer or "
+                         f"range.")
+
+    # Each digit contributes digit * 10 ** (places before the end of its run).
+    places = np.repeat(ends, lengths) - np.flatnonzero(is_digit)
+    digits = (buf[is_digit] - ord("0")).astype(np.int64)
+    values = np.add.reduceat(digits * POWERS_OF_TEN[places], np.cumsum(lengths) - lengths)
+    values[(lengths == 2) & (values == 0)] = 100
+    return values[first], values[first + runs - 1]
+
+
+def parse_d100(ws: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function transforms the D100 string column of a worksheet into separate
+    columns of integers labeled Roll and Max (see parse_d100_fields).
+    :param ws: pd.DataFrame
+    :return: pd.DataFrame
+    """
+    rolls, maxes = parse_d100_fields(ws["D100"])
+    ws["Roll"] = pd.Series(rolls, index=ws.index)
+    ws["Max"] = pd.Series(maxes, index=ws.index)
+    return ws
+
+
+def read_sheet(xl: pd.ExcelFile, tab: str) -> pd.DataFrame:
+    """
+    This function parses one worksheet from an already opened workbook.
+    :param xl: pd.ExcelFile
+    :param tab: str
+    :return: pd.DataFrame
+    """
+    return xl.parse(sheet_name=tab, index_col=None, na_values=False)
+
+
 def import_workbook(tabs: list, filepath):
     """
     This function takes a list of tab names and a filepath to an excel workbook
     and returns a dictionary of pandas dataframes, using the tab names as keys.
     The first two columns are created by transforming the D100 string columns into
     separate columns of integers labeled Roll and Max.
+    Every sheet is parsed up front; use TableRegistry to load, validate, and
+    compile sheets only when they are needed.
     :param tabs: list of str
     :param filepath: filepath
     :return: dict of pd.DataFrame
     """
-    wb = pd.read_excel(filepath, sheet_name=tabs, index_col=None, na_values=False)
-    for tab in tabs:
-        print(f"tab: {tab}")
-        rolls = []
-        maxes = []
-        for i in range(len(wb[tab])):
-            item = wb[tab]["D100"][i].split("–")
-            # print(f"item: {item}")
-            if len(item) > 1:
-                rolls.append(int(item[0]))
-                maxes.append(int(item[1]))
-            else:
-                try:
-                    temp = int(item[0])
-                except ValueError:
-                    item = wb[tab]["D100"][i].split("-")
-                rolls.append(int(item[0]))
-                maxes.append(int(item[0]))
-        roll_s = pd.Series(rolls, index=None)
-        max_s = pd.Series(maxes, index=None)
-        wb[tab]["Roll"] = roll_s
-        wb[tab]["Max"] = max_s
+    wb = {}
+    with pd.ExcelFile(filepath) as xl:
+        for tab in tabs:
+            logger.debug("tab: %s", tab)
+            with metrics.timer("parse sheet"):
+                wb[tab] = parse_d100(read_sheet(xl, tab))
     return wb
 
 
-def roll_result(table: pd.DataFrame) -> str:
+# An ENCOUNTER cell starting with this refers to another sheet to roll on, e.g.
+# "@Scenery Tier0".
+REFERENCE_PREFIX = "@"
+
+
+def reference_of(encounter):
+    """
+    This function returns the name of the sheet an ENCOUNTER cell refers to, or
+    None if it is an ordinary encounter.
+    :param encounter: str
+    :return: str or None
+    """
+    if isinstance(encounter, str) and encounter.startswith(REFERENCE_PREFIX):
+        return encounter[len(REFERENCE_PREFIX):].strip() or None
+    return None
+
+
+def mix64(x) -> np.ndarray:
+    """
+    The splitmix64 finalizer: a bijection on 64-bit integers that turns a counter
+    into a well-mixed random value. Arithmetic wraps around modulo 2 ** 64.
+    :param x: np.ndarray of np.uint64
+    :return: np.ndarray of np.uint64
+    """
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+class StringPool:
+    """
+    A deduplicated pool of strings shared by many tables. Each distinct string is
+    kept once and referred to by its code, its position in the pool, so columns
+    that repeat the same few ENCOUNTER and TYPE values over hundreds of sheets
+    cost four bytes a row. Codes never change once given out, and a pool can be
+    shared between threads.
+    """
+
+    def __init__(self):
+        self._codes = {}
+        self._strings = []
+        self._array = np.empty(0, dtype=object)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __repr__(self):
+        return f"StringPool(strings={len(self)})"
+
+    def __getstate__(self):
+        return self._strings
+
+    def __setstate__(self, strings):
+        self.__init__()
+        self._strings = list(strings)
+        self._codes = {string: code for code, string in enumerate(self._strings)}
+
+    def intern(self, strings) -> np.ndarray:
+        """
+        Returns the code of each string, adding the ones not in the pool yet.
+        Values that are not strings are pooled as their str().
+        :param strings: sequence of str
+        :return: np.ndarray of np.int32
+        """
+        # Only the distinct values of the column go through the dictionary.
+        codes, uniques = pd.factorize(np.asarray(strings, dtype=object),
+                                      use_na_sentinel=False)
+        with self._lock:
+            pooled = np.empty(len(uniques), dtype=np.int32)
+            for i, string in enumerate(uniques):
+                string = str(string)
+                code = self._codes.get(string)
+                if code is None:
+                    code = self._codes[string] = len(self._strings)
+                    self._strings.append(string)
+                pooled[i] = code
+        return pooled[codes]
+
+    @property
+    def strings(self) -> np.ndarray:
+        """
+        Every string in the pool as an object array, indexed by code.
+        :return: np.ndarray of str
+        """
+        if len(self._array) != len(self._strings):
+            with self._lock:
+                self._array = np.array(self._strings + [None], dtype=object)[:-1]
+        return self._array
+
+    def decode(self, codes) -> np.ndarray:
+        """
+        Returns the strings for an array of codes, with None where a code is -1.
+        :param codes: np.ndarray of int
+        :return: np.ndarray of str
+        """
+        codes = np.asarray(codes)
+        result = np.full(codes.shape, None, dtype=object)
+        found = codes >= 0
+        result[found] = self.strings[codes[found]]
+        return result
+
+
+# The pool for tables compiled outside of a TableRegistry.
+DEFAULT_POOL = StringPool()
+
+
+class CompiledTable:
+    """
+    A random encounter table compiled once from a worksheet. The Roll and Max
+    columns are held as sorted integer arrays and ENCOUNTER and TYPE as parallel
+    arrays of codes into a StringPool, so a roll is resolved with a binary search
+    instead of filtering the whole DataFrame every time, and strings repeated
+    across rows and tables are only stored once. Many rolls can be resolved at once
+    with indices_of and roll_many.
+    Rows whose ENCOUNTER refers to another sheet (see reference_of) are rolled
+    again on that sheet by roll, roll_many, and resolve_labels. The sheets are
+    found in subtables, which TableRegistry fills in when it loads the table.
+    """
+
+    def __init__(self, rolls, maxes, encounters, types, name=None, pool=None):
+        order = np.argsort(np.asarray(rolls, dtype=np.int64), kind="stable")
+        self.name = name
+        self.pool = pool if pool is not None else DEFAULT_POOL
+        self.rolls = np.ascontiguousarray(np.asarray(rolls, dtype=np.int64)[order])
+        self.maxes = np.ascontiguousarray(np.asarray(maxes, dtype=np.int64)[order])
+        self.encounter_codes = self.pool.intern(np.asarray(encounters, dtype=object)[order])
+        self.type_codes = self.pool.intern(np.asarray(types, dtype=object)[order])
+        if len(self.rolls) == 0:
+            raise ValueError(f"Table {name} has no rows to roll against.")
+        self.min_roll = int(self.rolls[0])
+        self.max_roll = int(self.maxes.max())
+        self.subtables = {}
+        self._label_codes = None
+        self._targets = None
+        self._target_index = None
+
+    def __len__(self):
+        return len(self.rolls)
+
+    def __repr__(self):
+        return f"CompiledTable({self.name!r}, rows={len(self)}, " \
+               f"range={self.min_roll}-{self.max_roll})"
+
+    def random_roll(self, rng=random) -> int:
+        """
+        Returns a random integer between the lowest Roll and the highest Max of
+        the table, inclusive.
+        :param rng: random.Random or the random module
+        :return: int
+        """
+        return rng.randint(self.min_roll, self.max_roll)
+
+    def index_of(self, roll: int) -> int:
+        """
+        Returns the row index whose Roll..Max range contains roll. Raises a
+        ValueError if the roll falls outside of every range in the table.
+        :param roll: int
+        :return: int
+        """
+        idx = int(np.searchsorted(self.rolls, roll, side="right")) - 1
+        if idx < 0 or roll > self.maxes[idx]:
+            raise ValueError(f"Roll {roll} has no entry in table {self.name}.")
+        return idx
+
+    def lookup(self, roll: int) -> tuple:
+        """
+        Returns the ENCOUNTER and TYPE for a specific roll.
+        :param roll: int
+        :return: tuple of (str, str)
+        """
+        idx = self.index_of(roll)
+        strings = self.pool.strings
+        return strings[self.encounter_codes[idx]], strings[self.type_codes[idx]]
+
+    def result(self, roll: int) -> str:
+        """
+        Returns the formatted result for a specific roll, "ENCOUNTER (TYPE)".
+        :param roll: int
+        :return: str
+        """
+        return self.labels_of(self.index_of(roll))
+
+    def roll(self, rng=random) -> str:
+        """
+        Rolls once against the table and returns the formatted result.
+        :param rng: random.Random or the random module
+        :return: str
+        """
+        start = time.perf_counter() if metrics.enabled else None
+        roll = self.random_roll(rng)
+        logger.debug("roll: %s on %s", roll, self.name)
+        result = self.resolve(self.index_of(roll), rng)
+        if start is not None:
+            metrics.add("roll", time.perf_counter() - start)
+        return result
+
+    @property
+    def encounters(self) -> np.ndarray:
+        """
+        The ENCOUNTER of every row.
+        :return: np.ndarray of str
+        """
+        return self.pool.strings[self.encounter_codes]
+
+    @property
+    def types(self) -> np.ndarray:
+        """
+        The TYPE of every row.
+        :return: np.ndarray of str
+        """
+        return self.pool.strings[self.type_codes]
+
+    @property
+    def label_codes(self) -> np.ndarray:
+        """
+        The pool code of the formatted result of every row, "ENCOUNTER (TYPE)",
+        built on first use. Each distinct pair is only formatted once.
+        :return: np.ndarray of np.int32
+        """
+        if self._label_codes is None:
+            pairs = (self.encounter_codes.astype(np.int64) << 32) | self.type_codes
+            unique, inverse = np.unique(pairs, return_inverse=True)
+            strings = self.pool.strings
+            labels = [f"{strings[pair >> 32]} ({strings[pair & 0xFFFFFFFF]})"
+                      for pair in unique.tolist()]
+            self._label_codes = self.pool.intern(labels)[inverse]
+        return self._label_codes
+
+    @property
+    def labels(self) -> np.ndarray:
+        """
+        The formatted result of every row, "ENCOUNTER (TYPE)".
+        :return: np.ndarray of str
+        """
+        codes = self.label_codes
+        return self.pool.strings[codes]
+
+    def labels_of(self, idx):
+        """
+        Returns the formatted results of the given rows, without building the
+        labels of the whole table. The strings come from the pool, so results are
+        never copies.
+        :param idx: int or np.ndarray of int
+        :return: str or np.ndarray of str
+        """
+        codes = self.label_codes[idx]
+        return self.pool.strings[codes]
+
+    def indices_of(self, rolls) -> np.ndarray:
+        """
+        Returns the row index for each of an array of rolls. Raises a ValueError if
+        any roll falls outside of every range in the table.
+        :param rolls: np.ndarray of int
+        :return: np.ndarray of int
+        """
+        rolls = np.asarray(rolls, dtype=np.int64)
+        idx = np.searchsorted(self.rolls, rolls, side="right") - 1
+        missed = (idx < 0) | (rolls > self.maxes[np.maximum(idx, 0)])
+        if missed.any():
+            raise ValueError(f"Roll {rolls[missed][0]} has no entry in table "
+                             f"{self.name}.")
+        return idx
+
+    def key_indices(self, keys) -> np.ndarray:
+        """
+        Returns the row index for each of an array of random 64-bit keys, e.g. from
+        journey.counter_keys, by reducing each key to a roll between min_roll and
+        max_roll. The modulo bias is at most span / 2 ** 64, far too small to matter.
+        :param keys: np.ndarray of np.uint64
+        :return: np.ndarray
+        """
+        span = np.uint64(self.max_roll - self.min_roll + 1)
+        rolls = (np.asarray(keys, dtype=np.uint64) % span).astype(np.int64)
+        return self.indices_of(rolls + self.min_roll)
+
+    def roll_indices(self, size, rng=None) -> np.ndarray:
+        """
+        Rolls size times against the table at once and returns the row index of
+        each result.
+        :param size: int or tuple of int
+        :param rng: np.random.Generator
+        :return: np.ndarray of int
+        """
+        start = time.perf_counter() if metrics.enabled else None
+        rng = rng or np.random.default_rng()
+        rolls = rng.integers(self.min_roll, self.max_roll, size=size, endpoint=True)
+        idx = self.indices_of(rolls)
+        if start is not None:
+            metrics.add("roll", time.perf_counter() - start, idx.size)
+        return idx
+
+    def roll_many(self, size, rng=None) -> np.ndarray:
+        """
+        Rolls size times against the table at once and returns an array of the
+        formatted results.
+        :param size: int or tuple of int
+        :param rng: np.random.Generator
+        :return: np.ndarray of str
+        """
+        rng = rng or np.random.default_rng()
+        return self.resolve_labels(self.roll_indices(size, rng), rng)
+
+    @property
+    def targets(self) -> list:
+        """
+        The names of the sheets that ENCOUNTER cells of this table refer to.
+        :return: list of str
+        """
+        if self._targets is None:
+            self._find_references()
+        return self._targets
+
+    @property
+    def target_index(self) -> np.ndarray:
+        """
+        For every row, the index in targets of the sheet it refers to, or -1.
+        :return: np.ndarray of np.int32
+        """
+        if self._target_index is None:
+            self._find_references()
+        return self._target_index
+
+    def _find_references(self):
+        # Only the distinct ENCOUNTER codes are checked for references.
+        inverse, codes = pd.factorize(self.encounter_codes)
+        found = [reference_of(encounter) for encounter in self.pool.strings[codes]]
+        targets = list(dict.fromkeys(name for name in found if name is not None))
+        lookup = np.array([-1 if name is None else targets.index(name)
+                           for name in found], dtype=np.int32)
+        self._target_index = lookup[inverse]
+        self._targets = targets
+
+    def _subtable(self, target: int):
+        name = self.targets[target]
+        table = self.subtables.get(name)
+        if table is None:
+            raise ValueError(f"{self.name} refers to {name}, which was not loaded "
+                             f"with it.")
+        return table
+
+    def resolve(self, idx: int, rng=random) -> str:
+        """
+        Returns the formatted result of a row, rolling on the sheet it refers to,
+        and on any sheet that one refers to, if it is a reference.
+        :param idx: int
+        :param rng: random.Random or the random module
+        :return: str
+        """
+        target = self.target_index[idx]
+        if target < 0:
+            return self.labels_of(idx)
+        return self._subtable(target).roll(rng)
+
+    def resolve_labels(self, rows, rng=None, keys=None) -> np.ndarray:
+        """
+        Returns the formatted result of each of an array of rows, like labels_of,
+        but with references rolled on the sheets they refer to. Each level of
+        references is rolled for all rows at once. With keys, the random keys the
+        rows were drawn from (see key_indices), the rolls on sub-tables are drawn
+        from keys derived from them with mix64, so they are just as reproducible;
+        otherwise they are drawn from rng.
+        :param rows: np.ndarray of int
+        :param rng: np.random.Generator
+        :param keys: np.ndarray of np.uint64, or None
+        :return: np.ndarray of str
+        """
+        rows = np.asarray(rows)
+        if not self.targets:
+            return self.labels_of(rows)
+        targets = self.target_index[rows]
+        results = np.empty(rows.shape, dtype=object)
+        plain = targets < 0
+        results[plain] = self.labels_of(rows[plain])
+        rng = rng if rng is not None or keys is not None else np.random.default_rng()
+        for target in np.unique(targets[~plain]).tolist():
+            chosen = targets == target
+            table = self._subtable(target)
+            if keys is None:
+                sub_rows = table.roll_indices(int(chosen.sum()), rng)
+                results[chosen] = table.resolve_labels(sub_rows, rng)
+            else:
+                sub_keys = mix64(keys[chosen])
+                results[chosen] = table.resolve_labels(table.key_indices(sub_keys),
+                                                       keys=sub_keys)
+        return results
+
+
+def compile_table(table: pd.DataFrame, name=None, pool=None) -> CompiledTable:
+    """
+    This function converts a DataFrame produced by import_workbook, with columns
+    Roll (int), Max (int), ENCOUNTER (str), and TYPE (str), into a CompiledTable.
+    :param table: pd.DataFrame
+    :param name: str
+    :param pool: StringPool, or None for DEFAULT_POOL
+    :return: CompiledTable
+    """
+    return CompiledTable(table["Roll"].to_numpy(),
+                         table["Max"].to_numpy(),
+                         table["ENCOUNTER"].to_numpy(dtype=object),
+                         table["TYPE"].to_numpy(dtype=object),
+                         name=name, pool=pool)
+
+
+def compile_workbook(workbook: dict, pool=None) -> dict:
+    """
+    This function compiles every DataFrame in the dictionary returned by
+    import_workbook, keeping the tab names as keys. The tables share one pool.
+    :param workbook: dict of pd.DataFrame
+    :param pool: StringPool, or None for DEFAULT_POOL
+    :return: dict of CompiledTable
+    """
+    return {tab: compile_table(table, name=tab, pool=pool)
+            for tab, table in workbook.items()}
+
+
+def roll_result(table) -> str:
     """
     This function accepts a random encounter table, determines the range for the
     random roll, and returns the string result corresponding to the roll. This table
-    must have the following columns: Roll (int), Max (int), TYPE (str), and
-    ENCOUNTER (str). There can be no overlap between the ranges specified by Roll
-    and Max in each row and Roll <= Max. There can be no blank spaces in these columns.
-    :param table: pd.DataFrame
+    is either a CompiledTable or a DataFrame that must have the following columns:
+    Roll (int), Max (int), TYPE (str), and ENCOUNTER (str). There can be no overlap
+    between the ranges specified by Roll and Max in each row and Roll <= Max. There
+    can be no blank spaces in these columns.
+    A DataFrame is compiled on every call, so callers rolling repeatedly should
+    compile their tables once with compile_table or compile_workbook.
+    :param table: CompiledTable or pd.DataFrame
     :return: str: result
     """
-    # Find the min and max for the roll range. These encounter tables can have
-    # numbers far above 100.
-    min_roll = table["Roll"].min()
-    max_roll = table["Max"].max()
-
-    roll = random.randint(min_roll, max_roll)
-    print(f"roll: {roll}")
-    # Filter for smaller than or equal to roll in table.Roll.
-    filtered = table.loc[table.Roll <= roll]
-    print(f"1st filter: {filtered}")
-    # Now, filter again for larger than or equal to roll in table.Max.
-    # This should reduce it to a single row if there are no overlaps.
-    filtered = filtered.loc[filtered.Max >= roll]
-    print(f"2nd filter: {filtered}")
-    result = filtered["ENCOUNTER"].squeeze()
-    type_result = filtered["TYPE"].squeeze()
-    return f"{result} ({type_result})"
+    if not isinstance(table, CompiledTable):
+        table = compile_table(table)
+    # These encounter tables can have numbers far above 100.
+    return table.roll()
+
+
+def open_cache(filepath):
+    """
+    This function opens the compiled-table cache kept next to a workbook. If the
+    sidecar cannot be created or read, it returns None and loading carries on
+    without a cache.
+    :param filepath: filepath
+    :return: tablecache.TableCache or None
+    """
+    try:
+        return tablecache.TableCache(filepath)
+    except sqlite3.Error as e:
+        logger.warning("Table cache for %s is unavailable: %s", filepath, e)
+        return None
+
+
+class TableRegistry(Mapping):
+    """
+    A read-only mapping of tab names to CompiledTables that loads each sheet the
+    first time it is asked for. Sheets are streamed row by row through openpyxl's
+    read-only mode, validated (see validate_workbook), and compiled, without ever
+    building a DataFrame. Compiled sheets are also kept in the cache sidecar (see
+    tablecache) unless use_cache is False. Looking up a sheet that fails
+    validation raises a ValueError describing the failure.
+    A registry can be shared between threads, e.g. with a BackgroundLoader; sheets
+    are loaded one at a time. All of its tables share one StringPool, so memory
+    grows with the number of distinct strings rather than the number of rows.
+    A sheet whose ENCOUNTER cells refer to other sheets (see reference_of) loads
+    them too and is linked to them, so rolls follow references without looking
+    sheets up again. It fails if one of them is missing or fails, or if the
+    references form a cycle.
+    When the workbook is edited, refresh builds the registry that replaces it,
+    loading again only the sheets that changed (see watcher).
+    """
+
+    def __init__(self, tables: list, filepath, use_cache=True, pool=None):
+        self.tables = list(tables)
+        self.filepath = filepath
+        self.use_cache = use_cache
+        self.pool = pool if pool is not None else StringPool()
+        self._compiled = {}
+        self._failures = {}
+        # Sheets whose own failure was in their references rather than their rows.
+        self._reference_failures = set()
+        # Tables from an earlier registry to link again instead of loading again.
+        self._carried = {}
+        self._wb = None
+        self._cache = None
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        if name not in self.tables:
+            raise KeyError(name)
+        return self.load(name)
+
+    def __contains__(self, name):
+        # Mapping's version would load the sheet, and raise if it fails.
+        return name in self.tables
+
+    def __iter__(self):
+        return iter(self.tables)
+
+    def __len__(self):
+        return len(self.tables)
+
+    def __repr__(self):
+        return f"TableRegistry({self.filepath!r}, tables={len(self)}, " \
+               f"loaded={len(self._compiled)})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Closes the workbook and the cache, if they were opened. Tables that were
+        already loaded remain available.
+        :return: None
+        """
+        with self._lock:
+            if self._wb is not None:
+                self._wb.close()
+                self._wb = None
+            if self._cache is not None:
+                self._cache.close()
+                self._cache = None
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._compiled
+
+    def failure(self, name: str):
+        """
+        Returns the description of why a sheet failed to load, or None if it has
+        loaded or has not been tried yet.
+        :param name: str
+        :return: str or None
+        """
+        return self._failures.get(name)
+
+    def load(self, name: str, _chain=()) -> CompiledTable:
+        """
+        Returns the CompiledTable for a sheet, loading it first if necessary.
+        :param name: str
+        :return: CompiledTable
+        """
+        if name in self._compiled:
+            return self._compiled[name]
+        with self._lock:
+            if name in self._compiled:
+                return self._compiled[name]
+            if name not in self._failures:
+                failure, table = self._load(name)
+                if failure is None:
+                    failure = self._link(table, _chain + (name,))
+                    if failure is not None:
+                        self._reference_failures.add(name)
+                if failure is None:
+                    self._compiled[name] = table
+                    return table
+                self._failures[name] = failure
+        raise ValueError(self._failures[name])
+
+    def _link(self, table: CompiledTable, chain: tuple):
+        """
+        Loads the sheets a table refers to and links them into its subtables.
+        chain holds the sheets being linked, from the first one loaded down to
+        table, to catch references that lead back to one of them.
+        Returns the failure, or None.
+        """
+        for target in table.targets:
+            if target in chain:
+                cycle = " -> ".join(chain[chain.index(target):] + (target,))
+                return f"{table.name} Reference cycle: {cycle}"
+            if target not in self.tables:
+                return f"{table.name} refers to {target}, which is not in the table list"
+            try:
+                table.subtables[target] = self.load(target, chain)
+            except ValueError:
+                return f"{table.name} refers to {target}, which failed validation"
+        return None
+
+    def refresh(self, tables: list, changed) -> "TableRegistry":
+        """
+        Returns a new registry for the same workbook, after the sheets named in
+        changed were edited and the table list was replaced by tables. The new
+        registry has loaded, or failed, every table that this one had and every
+        changed one in the list, but only the changed sheets are read, validated,
+        and compiled again. The other tables are carried over as they are, or
+        linked again if a table they refer to changed. This registry is left
+        untouched, so whoever uses it can keep doing so until they swap in the new
+        one.
+        :param tables: list of str
+        :param changed: collection of str, names of sheets that were edited, added,
+            or removed
+        :return: TableRegistry
+        """
+        changed = set(changed)
+        registry = TableRegistry(tables, self.filepath, self.use_cache, self.pool)
+        with self._lock:
+            compiled, failures = dict(self._compiled), dict(self._failures)
+            reference_failures = set(self._reference_failures)
+            previous = self._cache.digest if self._cache is not None else None
+
+        def unchanged(table):
+            # References never form a cycle among loaded tables.
+            return (table.name not in changed and table.name in registry.tables
+                    and all(unchanged(subtable) for subtable in table.subtables.values()))
+
+        for name, table in compiled.items():
+            if unchanged(table):
+                registry._compiled[name] = table
+            elif name not in changed and name in registry.tables:
+                registry._carried[name] = table
+        for name, failure in failures.items():
+            if (name not in changed and name in registry.tables
+                    and name not in reference_failures):
+                registry._failures[name] = failure
+        if previous is not None:
+            # The sheets that did not change need not be read to be trusted again.
+            registry._cache = open_cache(self.filepath)
+            if registry._cache is not None:
+                registry._cache.carry_over(
+                    [name for name in registry.tables if name not in changed], previous)
+        for name in registry.tables:
+            if name in compiled or name in failures or name in changed:
+                try:
+                    registry.load(name)
+                except ValueError as e:
+                    logger.info("%s", e)
+        registry._carried.clear()
+        return registry
+
+    def _load(self, name: str) -> tuple:
+        carried = self._carried.pop(name, None)
+        if carried is not None:
+            table = copy.copy(carried)
+            table.subtables = {}
+            return None, table
+        if self.use_cache and self._cache is None:
+            self._cache = open_cache(self.filepath)
+        cached = self._cache.get(name) if self._cache is not None else None
+        if cached is not None:
+            metrics.count("cache hits")
+            logger.debug("Loaded %s from the cache", name)
+            return None, CompiledTable(*cached, name=name, pool=self.pool)
+
+        if self._wb is None:
+            with metrics.timer("open workbook"):
+                self._wb = openpyxl.load_workbook(self.filepath, read_only=True,
+                                                  data_only=True)
+        if name not in self._wb.sheetnames:
+            return f"{name} was not found in the workbook", None
+        start = time.perf_counter()
+        failure, columns = collect_columns(name, iter_sheet_rows(self._wb[name]))
+        elapsed = time.perf_counter() - start
+        metrics.add(f"read sheet: {name}", elapsed)
+        logger.debug("Read %s in %.3fs", name, elapsed)
+        if failure is not None:
+            return failure, None
+
+        digest = None
+        if self._cache is not None:
+            digest = tablecache.sheet_digest(columns)
+            cached = self._cache.get(name, digest)
+            if cached is not None:
+                metrics.count("cache hits")
+                logger.debug("%s is unchanged; loaded it from the cache", name)
+                return None, CompiledTable(*cached, name=name, pool=self.pool)
+            metrics.count("cache misses")
+        failure, rolls, maxes = validate_columns(name, columns)
+        if failure is not None:
+            return failure, None
+        table = CompiledTable(rolls, maxes, columns["ENCOUNTER"], columns["TYPE"],
+                              name=name, pool=self.pool)
+        if self._cache is not None:
+            self._cache.put(name, digest, table)
+        return None, table
+
+    def validate_all(self):
+        """
+        Loads every table in the registry and returns the list of failures, or
+        None if every table passed.
+        :return: list of str or None
+        """
+        bad_tables = []
+        for name in self.tables:
+            try:
+                self.load(name)
+            except ValueError as e:
+                logger.info("%s", e)
+                bad_tables.append(str(e))
+        if not bad_tables:
+            return None
+        else:
+            return bad_tables
+
+
+def iter_sheet_rows(ws):
+    """
+    This function streams the rows of an openpyxl worksheet as tuples of cell
+    values, each with its worksheet row number, skipping rows that are entirely
+    empty.
+    :param ws: openpyxl worksheet
+    :return: generator of tuple of (int, tuple)
+    """
+    for number, row in enumerate(ws.iter_rows(values_only=True), start=1):
+        if any(value is not None for value in row):
+            yield number, row
+
+
+class BackgroundLoader:
+    """
+    Loads and validates every table of a TableRegistry on a worker thread. Tables
+    listed in first, and any passed to prioritize later, are loaded before the
+    rest; those not in the registry's table list are skipped. After each table, progress is called with (name, done, total, failure),
+    where failure is None if the table passed; once the loader finishes or is
+    cancelled, it is called one last time with a name of None.
+    """
+
+    def __init__(self, registry: TableRegistry, progress=None, first=()):
+        self.registry = registry
+        self.progress = progress
+        self.total = len(registry.tables)
+        self.done = 0
+        first = [name for name in first if name in registry]
+        self._queue = deque(dict.fromkeys(first + registry.tables))
+        self._queue_lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._close = False
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="table loader")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self, close=False):
+        """
+        Stops the loader after the table it is loading now. If close is True, the
+        registry is closed once the loader has stopped, without waiting for it here.
+        :param close: bool
+        :return: None
+        """
+        self._cancelled.set()
+        with self._queue_lock:
+            self._close = close
+            finished = self._finished
+        if close and finished:
+            self.registry.close()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def prioritize(self, name: str):
+        """
+        Moves a table that has not been loaded yet to the front of the queue.
+        :param name: str
+        :return: None
+        """
+        with self._queue_lock:
+            if name in self._queue:
+                self._queue.remove(name)
+                self._queue.appendleft(name)
+
+    def _next(self):
+        with self._queue_lock:
+            return self._queue.popleft() if self._queue else None
+
+    def _run(self):
+        while not self._cancelled.is_set():
+            name = self._next()
+            if name is None:
+                break
+            failure = None
+            try:
+                self.registry.load(name)
+            except Exception as e:
+                # Reported through progress rather than lost with the thread.
+                failure = str(e)
+            self.done += 1
+            if self.progress is not None and not self._cancelled.is_set():
+                self.progress(name, self.done, self.total, failure)
+        with self._queue_lock:
+            self._finished = True
+            close = self._close
+        if close:
+            self.registry.close()
+        if self.progress is not None:
+            self.progress(None, self.done, self.total, None)
+
+
+def load_workbook(tables: list, filepath, use_cache=True):
+    """
+    This function loads, validates (see validate_workbook), and compiles every one
+    of the tables in a single pass over the workbook, streaming one sheet at a
+    time. It returns the compiled tables that passed, keyed by tab name, and the
+    list of failures, or None if every table passed.
+    Compiled tables are kept in a cache sidecar next to the workbook (see
+    tablecache). When the workbook is unchanged they are read from the cache
+    without opening the workbook; when it has changed, only the sheets whose
+    contents differ are validated and compiled again.
+    :param tables: list of str
+    :param filepath: filepath
+    :param use_cache: bool
+    :return: tuple of (dict of CompiledTable, list of str or None)
+    """
+    with TableRegistry(tables, filepath, use_cache=use_cache) as registry:
+        bad_tables = registry.validate_all()
+        compiled = {name: registry.load(name) for name in tables
+                    if registry.is_loaded(name)}
+    return compiled, bad_tables
+
+
+def find_overlaps_and_gaps(rolls, maxes) -> list:
+    """
+    This function compares each row of a table with the previous one to find the
+    ranges of rolls that are covered more than once (overlaps) or not at all (gaps).
+    Both sequences must already be sorted in ascending order with each Roll <= Max.
+    The cost depends only on the number of rows, not on the span of the rolls.
+    :param rolls: array of int
+    :param maxes: array of int
+    :return: list of str, e.g. ["overlap 10-12", "gap 20"]
+    """
+    rolls = np.asarray(rolls, dtype=np.int64)
+    maxes = np.asarray(maxes, dtype=np.int64)
+    prev_maxes = maxes[:-1]
+    next_rolls = rolls[1:]
+    bad_ranges = []
+    for i in np.flatnonzero(next_rolls != prev_maxes + 1):
+        if next_rolls[i] <= prev_maxes[i]:
+            kind, low, high = "overlap", next_rolls[i], prev_maxes[i]
+        else:
+            kind, low, high = "gap", prev_maxes[i] + 1, next_rolls[i] - 1
+        if low == high:
+            bad_ranges.append(f"{kind} {low}")
+        else:
+            bad_ranges.append(f"{kind} {low}-{high}")
+    return bad_ranges
+
+
+def collect_columns(table: str, rows):
+    """
+    This function reads the rows of a worksheet, the first of which holds the
+    column titles, testing properties 1 and 2 of validate_workbook as it goes. It
+    returns a description of the failed property, or None, together with the
+    D100, ENCOUNTER, and TYPE columns as lists of str, and the worksheet row each
+    value came from as a list of int under "Row".
+    :param table: str
+    :param rows: iterable of (int, tuple), as from iter_sheet_rows
+    :return: tuple of (str or None, dict of list)
+    """
+    rows = iter(rows)
+    _, header = next(rows, (0, ()))
+    # Testing the first property.
+    try:
+        d100_idx = header.index("D100")
+        enc_idx = header.index("ENCOUNTER")
+        type_idx = header.index("TYPE")
+    except ValueError:
+        return f"{table} Property 1 Failed", None
+    # print(f"{table} passed Property 1 Test.")
+
+    # Testing the second property on every titled column.
+    titled = [i for i, title in enumerate(header) if title is not None]
+    columns = {"D100": [], "ENCOUNTER": [], "TYPE": [], "Row": []}
+    for number, row in rows:
+        row = row + (None,) * (len(header) - len(row))
+        if not all(isinstance(row[i], str) for i in titled):
+            return f"{table} Property 2 Failed", None
+        columns["D100"].append(row[d100_idx])
+        columns["ENCOUNTER"].append(row[enc_idx])
+        columns["TYPE"].append(row[type_idx])
+        columns["Row"].append(number)
+    # print(f"{table} passed Property 2 Test.")
+    return None, columns
+
+
+def validate_columns(table: str, columns: dict):
+    """
+    This function tests properties 3 through 8 of validate_workbook against the
+    columns returned by collect_columns. It returns a description of the first
+    failed property, or None, together with the Roll and Max arrays parsed from
+    D100 (None if properties 3 and 4 fail).
+    :param table: str
+    :param columns: dict of list of str
+    :return: tuple of (str or None, np.ndarray, np.ndarray)
+    """
+    # Parsing D100 tests properties 3 and 4.
+    try:
+        with metrics.timer("validate property 3-4"):
+            rolls, maxes = parse_d100_fields(columns["D100"], columns.get("Row"))
+    except ValueError as e:
+        return f"{table} Property 3 and/or 4 Failed: {e}", None, None
+    # print(f"{table} passed Property 3 and 4 Test.")
+    if len(rolls) == 0:
+        return f"{table} has no rows", rolls, maxes
+
+    # Testing property 5.
+    with metrics.timer("validate property 5"):
+        passed = (rolls <= maxes).all()
+    if not passed:
+        return f"{table} Property 5 Failed", rolls, maxes
+    # print(f"{table} passed Property 5 Test.")
+
+    # Testing property 6.
+    with metrics.timer("validate property 6"):
+        passed = (rolls[1:] >= rolls[:-1]).all() and (maxes[1:] >= maxes[:-1]).all()
+    if not passed:
+        return f"{table} Property 6 Failed", rolls, maxes
+    # print(f"{table} passed Property 6 Test.")
+
+    # Finally, we check properties 7 and 8. We know that both series ascend
+    # and Roll will never be greater than Max, so comparing each row with the
+    # one before it finds every overlap and gap in a single pass.
+    with metrics.timer("validate property 7-8"):
+        bad_ranges = find_overlaps_and_gaps(rolls, maxes)
+    if bad_ranges:
+        return f"{table} Prop 7/8 Failed at ranges: {', '.join(bad_ranges)}", \
+            rolls, maxes
+    logger.debug("%s passed all tests.", table)
+    return None, rolls, maxes
 
 
 def validate_workbook(tables, filepath):
     """
-    This function looks at each of the tables (DataFrames) in the workbook to
+    This function looks at each of the tables (worksheets) in the workbook to
     make sure that all of them adhere to the required standards. It will return
     a list of bad tables if any are found or None if the workbook is ok.
     The requirements are as follows:
@@ -103,95 +1102,25 @@ def validate_workbook(tables, filepath):
             maximum, however.
         7. In D100, no range of integers may overlap any other, including singles.
         8. In D100, there can be no gaps of even in single number either.
+        9. An ENCOUNTER of the form "@Sheet Name" must refer to another table in the
+            list that passes these checks, without leading back to the first one.
+    The workbook is opened once and streamed one sheet at a time; use
+    load_workbook to validate and compile the tables in the same pass.
     :param tables: list of str
     :param filepath: filepath
     :return: list of str or None
     """
-    wb = pd.read_excel(filepath, sheet_name=tables, index_col=None, na_values=False)
-    print(f"Loaded basic workbook")
-    bad_tables = []
-    for table in tables:
-        print(f"Testing table: {table}")
-        ws = wb[table]
-        print(f"Worksheet: {ws}")
-        # Testing the first property.
-        try:
-            roll_series = ws["D100"]
-            enc_series = ws["ENCOUNTER"]
-            type_series = ws["TYPE"]
-        except KeyError:
-            bad_tables.append(f"{table} Property 1 Failed")
-            continue
-        # print(f"{table} passed Property 1 Test.")
-
-        # Testing the second property.
-        ds = ws.applymap(lambda x: isinstance(x, str)).all()
-        if ds.all() is False:
-            bad_tables.append(f"{table} Property 2 Failed")
-            continue
-        # print(f"{table} passed Property 2 Test.")
-
-        # The import_workbook function will test properties 3 and 4.
-        try:
-            new_wb = import_workbook([table], filepath)
-        except ValueError:
-            bad_tables.append(f"{table} Property 3 and/or 4 Failed")
-            continue
-        else:
-            new_ws = new_wb[table]
-        # print(f"{table} passed Property 3 and 4 Test.")
-
-        # Testing property 5.
-        ds = new_ws["Roll"] <= new_ws["Max"]
-        if ds.all() is False:
-            bad_tables.append(f"{table} Property 5 Failed")
-            continue
-        # print(f"{table} passed Property 5 Test.")
-
-        # Testing property 6.
-        r1 = r2 = new_ws["Roll"].tolist()
-        m1 = m2 = new_ws["Max"].tolist()
-        r1.sort()
-        m1.sort()
-        if r1 != r2 or m1 != m2:
-            bad_tables.append(f"{table} Property 6 Failed")
-            continue
-        # print(f"{table} passed Property 6 Test.")
-
-        # Finally, we check properties 7 and 8. We know that both series ascend
-        # and Roll will never be greater than Max. Every roll result between the
-        # minimum roll and maximum roll must produce exactly one row. Overlaps
-        # will produce more than one result, skips will produce an empty dataframe.
-        min_roll = new_ws["Roll"].min()
-        max_roll = new_ws["Max"].max()
-        bad = False
-        bad_nums = []
-        for i in range(min_roll, max_roll + 1):
-            filtered = new_ws.loc[new_ws.Roll <= i]
-            filtered = filtered.loc[filtered.Max >= i]
-            rows = filtered.shape[0]
-            print(f"Rows for Index {i}: {rows}")
-            if rows != 1:
-                bad = True
-                bad_nums.append(str(i))
-        if bad is True:
-            bad_tables.append(f"{table} Prop 7/8 Failed at indices: {bad_nums}")
-            continue
-        print(f"{table} passed all tests.")
-
-    if not bad_tables:
-        return None
-    else:
-        return bad_tables
+    with TableRegistry(tables, filepath, use_cache=False) as registry:
+        return registry.validate_all()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     tables = import_tables("./samples/tables.json")
     print(tables)
-    bad_tables = validate_workbook(tables, "./samples/encounters.xlsx")
+    workbook, bad_tables = load_workbook(tables, "./samples/encounters.xlsx")
     if bad_tables is None:
         print("Workbook passed the tests.")
-        workbook = import_workbook(tables, "./samples/encounters.xlsx")
         print(workbook)
         idx = random.randint(0, len(tables) - 1)
         print(f"idx: {idx}")
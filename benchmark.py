@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import openpyxl
+import backend
+import journey
+
+# Synthetic workbooks: (number of sheets, rows per sheet, span of each sheet).
+# A span of None gives dense d100-style rows one to three numbers wide.
+WORKBOOKS = {
+    "rows-10": (1, 10, None),
+    "rows-1k": (1, 1_000, None),
+    "rows-100k": (1, 100_000, None),
+    "rows-1m": (1, 1_000_000, None),
+    "span-huge": (1, 1_000, 10 ** 12),
+    "sheets-50": (50, 100, None),
+    "sheets-500": (500, 100, None),
+}
+QUICK_WORKBOOKS = ("rows-10", "rows-1k", "span-huge", "sheets-50")
+ENCOUNTERS = ["Bandit", "Cockatrice", "Social Encounter", "Travel Scenery", "Thug",
+              "Falling Net", "Hail Storm", "Public Ceremony", "Wolf", "Ghoul"]
+TYPES = ["Mnst", "Expl", "pg 103", "pg 105"]
+ROLLS = 10_000
+JOURNEY_DAYS = 365
+JOURNEYS = 1_000
+# Where --save records results and --compare reads them by default. Timings only
+# compare on the machine they were taken on, so the file is kept out of the repo.
+BASELINE = "./benchmark_baseline.json"
+# Smallest absolute increase over the baseline that counts as a regression.
+NOISE_FLOOR = {"seconds": 0.01, "peak_mb": 0.5}
+
+
+def make_workbook(filepath, sheets: dict):
+    """
+    This function writes a synthetic encounter workbook to disk. Each sheet is
+    given as a list of (D100, ENCOUNTER, TYPE) string tuples, keyed by sheet name.
+    :param filepath: filepath
+    :param sheets: dict of list of tuple
+    :return: None
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    for name, rows in sheets.items():
+        ws = wb.create_sheet(name)
+        ws.append(["D100", "ENCOUNTER", "TYPE"])
+        for row in rows:
+            ws.append(list(row))
+    wb.save(filepath)
+
+
+def sparse_rows(span: int, rows: int) -> list:
+    """
+    This function builds rows that cover 1..span with only a handful of very wide
+    ranges, the worst case for a validator that walks every integer in the span.
+    :param span: int
+    :param rows: int
+    :return: list of tuple
+    """
+    step = span // rows
+    result = []
+    for i in range(rows):
+        low = i * step + 1
+        high = span if i == rows - 1 else (i + 1) * step
+        result.append((f"{low}–{high}", f"Encounter {i}", "Mnst"))
+    return result
+
+
+def synthetic_rows(rows: int, span=None, seed=0) -> list:
+    """
+    This function builds a valid table of the given number of rows. Without a
+    span, each row covers one to three numbers, like a printed d100 list; with
+    one, the rows are spread evenly over 1..span.
+    :param rows: int
+    :param span: int or None
+    :param seed: int
+    :return: list of tuple
+    """
+    rng = random.Random(seed)
+    if span is not None:
+        step = span // rows
+        bounds = [(i * step + 1, span if i == rows - 1 else (i + 1) * step)
+                  for i in range(rows)]
+    else:
+        bounds = []
+        low = 1
+        for _ in range(rows):
+            high = low + rng.randint(0, 2)
+            bounds.append((low, high))
+            low = high + 1
+    return [(str(low) if low == high else f"{low}–{high}",
+             rng.choice(ENCOUNTERS), rng.choice(TYPES)) for low, high in bounds]
+
+
+def prepare_workbook(folder, name: str) -> tuple:
+    """
+    This function writes one of the WORKBOOKS, and the json listing its sheets,
+    into folder, unless they are already there from an earlier run.
+    :param folder: filepath
+    :param name: str
+    :return: tuple of (workbook filepath, json filepath)
+    """
+    sheets, rows, span = WORKBOOKS[name]
+    filepath = os.path.join(folder, f"{name}.xlsx")
+    json_path = os.path.join(folder, f"{name}.json")
+    tabs = [f"Table {i}" for i in range(sheets)]
+    if not os.path.exists(filepath):
+        make_workbook(filepath, {tab: synthetic_rows(rows, span, seed=i)
+                                 for i, tab in enumerate(tabs)})
+    with open(json_path, "w") as fp:
+        json.dump({"table list": tabs}, fp)
+    return filepath, json_path
+
+
+def measure(func, *args, memory=True, repeat=3) -> dict:
+    """
+    This function calls func repeat times and keeps the best wall time and, if
+    memory is True, once more under tracemalloc for the peak memory allocated
+    during the call.
+    :param func: callable
+    :param args: arguments for func
+    :param memory: bool
+    :param repeat: int
+    :return: dict with "seconds" and "peak_mb"
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    result = {"seconds": min(timings)}
+    if memory:
+        tracemalloc.start()
+        try:
+            func(*args)
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def bench_workbook(folder, name: str, memory=True, repeat=3) -> dict:
+    """
+    This function measures the load, validate, and roll hot paths and end-to-end
+    journey generation against one of the WORKBOOKS.
+    :param folder: filepath
+    :param name: str
+    :param memory: bool
+    :param repeat: int
+    :return: dict of dict, keyed by "<workbook> <benchmark>"
+    """
+    filepath, json_path = prepare_workbook(folder, name)
+    cache = f"{filepath}.cache"
+    tables = backend.import_tables(json_path)
+
+    def run(func, *args):
+        return measure(func, *args, memory=memory, repeat=repeat)
+
+    def load_cold():
+        if os.path.exists(cache):
+            os.remove(cache)
+        backend.load_workbook(tables, filepath)
+
+    results = {
+        "import_tables": run(backend.import_tables, json_path),
+        "validate_workbook": run(backend.validate_workbook, tables, filepath),
+        "import_workbook": run(backend.import_workbook, tables, filepath),
+        "load_workbook cold": run(load_cold),
+        "load_workbook warm": run(backend.load_workbook, tables, filepath),
+    }
+
+    workbook, _ = backend.load_workbook(tables, filepath)
+    table = workbook[tables[0]]
+
+    def rolls():
+        for _ in range(ROLLS):
+            backend.roll_result(table)
+
+    def journeys():
+        spec = journey.make_spec(JOURNEY_DAYS, tables[0], 20, night=True)
+        journey.generate_journeys(spec, workbook, JOURNEYS, np.random.default_rng(0))
+
+    results[f"roll_result x{ROLLS}"] = run(rolls)
+    results[f"journeys {JOURNEYS}x{JOURNEY_DAYS} days"] = run(journeys)
+    return {f"{name} {bench}": result for bench, result in results.items()}
+
+
+def bench_validate_sparse(span=1_000_000, rows=10, budget=5.0):
+    """
+    Regression benchmark for the Property 7/8 checks. A sparse table spanning
+    1..span must validate in well under the budget (seconds), and the same table
+    with one overlap and one gap must report exactly those ranges.
+    :param span: int
+    :param rows: int
+    :param budget: float
+    :return: float: seconds taken to validate the good workbook
+    """
+    good = sparse_rows(span, rows)
+    bad = list(good)
+    bad[1] = (f"{span // rows - 4}–{2 * span // rows}", "Overlap", "Mnst")
+    bad[3] = (f"{3 * span // rows + 1}–{4 * span // rows - 10}", "Gap", "Mnst")
+    with tempfile.TemporaryDirectory() as folder:
+        filepath = os.path.join(folder, "sparse.xlsx")
+        make_workbook(filepath, {"Good": good, "Bad": bad})
+
+        start = time.perf_counter()
+        result = backend.validate_workbook(["Good"], filepath)
+        elapsed = time.perf_counter() - start
+        assert result is None, result
+        assert elapsed < budget, f"Validation took {elapsed:.2f}s (budget {budget}s)"
+
+        result = backend.validate_workbook(["Bad"], filepath)
+        expected = f"overlap {span // rows - 4}-{span // rows}, " \
+                   f"gap {4 * span // rows - 9}-{4 * span // rows}"
+        assert result == [f"Bad Prop 7/8 Failed at ranges: {expected}"], result
+    return elapsed
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    This function compares benchmark results against a saved baseline and
+    returns a description of every measurement that is more than tolerance times
+    its baseline value. Differences below NOISE_FLOOR are ignored, since timings
+    of a few milliseconds are not stable enough to compare.
+    :param results: dict of dict
+    :param baseline: dict of dict
+    :param tolerance: float
+    :return: list of str
+    """
+    regressions = []
+    for bench, result in results.items():
+        for key, value in result.items():
+            base = baseline.get(bench, {}).get(key)
+            if base is None or value - base < NOISE_FLOOR[key]:
+                continue
+            if value > base * tolerance:
+                regressions.append(f"{bench} {key}: {value:.4f} vs baseline {base:.4f}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark loading, validating, and rolling on synthetic workbooks.")
+    parser.add_argument("workbooks", nargs="*",
+                        help=f"workbooks to benchmark, any of {', '.join(WORKBOOKS)} "
+                             f"(default: all, or the quick set)")
+    parser.add_argument("--quick", action="store_true",
+                        help=f"only benchmark {', '.join(QUICK_WORKBOOKS)}")
+    parser.add_argument("--folder", help="where synthetic workbooks are kept between "
+                                         "runs (default: a temporary folder)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the tracemalloc pass")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per benchmark, keeping the best (default: 3)")
+    parser.add_argument("--save", nargs="?", const=BASELINE,
+                        help=f"write the results to this baseline file "
+                             f"(default: {BASELINE})")
+    parser.add_argument("--compare", nargs="?", const=BASELINE,
+                        help=f"compare the results to this baseline file "
+                             f"(default: {BASELINE})")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="allowed ratio to the baseline before a regression is "
+                             "reported (default: 1.5)")
+    args = parser.parse_args()
+    unknown = set(args.workbooks) - set(WORKBOOKS)
+    if unknown:
+        parser.error(f"unknown workbooks: {', '.join(sorted(unknown))}")
+    if args.compare and not os.path.exists(args.compare):
+        parser.error(f"no baseline at {args.compare}; record one on this machine "
+                     f"with --save first")
+
+    names = args.workbooks or (QUICK_WORKBOOKS if args.quick else list(WORKBOOKS))
+    seconds = bench_validate_sparse()
+    print(f"validate_workbook, sparse 1..1,000,000 span: {seconds:.3f}s")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_folder:
+        folder = args.folder or temp_folder
+        os.makedirs(folder, exist_ok=True)
+        for name in names:
+            for bench, result in bench_workbook(folder, name, args.memory,
+                                                   args.repeat).items():
+                results[bench] = result
+                memory = f"  peak {result['peak_mb']:9.2f} MB" if "peak_mb" in result else ""
+                print(f"{bench:45} {result['seconds']:10.4f} s{memory}")
+
+    if args.save:
+        with open(args.save, "w") as fp:
+            json.dump(results, fp, indent=4)
+    if args.compare:
+        with open(args.compare, "r") as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(regression)
+            sys.exit(1)
+        print("No regressions against the baseline.")
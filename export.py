@@ -0,0 +1,195 @@
+import argparse
+import csv
+import gzip
+import io
+import json
+
+import numpy as np
+import backend
+import journey
+
+FORMATS = ("jsonl", "csv", "text")
+EXTENSIONS = {".jsonl": "jsonl", ".json": "jsonl", ".csv": "csv", ".txt": "text"}
+# Columns of the CSV export, and keys of each JSONL record.
+FIELDS = ("journey", "seed", "day", "table", "chance") + journey.TIMES_OF_DAY
+# Bytes buffered before each write to disk.
+BUFFER_SIZE = 1 << 20
+# Journeys rolled and written at a time by export_journeys.
+BATCH_SIZE = 1000
+
+
+def guess_format(filepath) -> str:
+    """
+    This function picks the export format from a file's extension, ignoring a
+    trailing .gz. Anything unrecognized is written as text.
+    :param filepath: filepath
+    :return: str, one of FORMATS
+    """
+    name = str(filepath).lower().removesuffix(".gz")
+    for extension, fmt in EXTENSIONS.items():
+        if name.endswith(extension):
+            return fmt
+    return "text"
+
+
+def open_output(filepath, compress=None):
+    """
+    This function opens a file for writing text through a large buffer,
+    compressing it with gzip if compress is True, or if compress is None and the
+    name ends in .gz. The gzip header holds no timestamp, so the same text always
+    gives the same file.
+    :param filepath: filepath
+    :param compress: bool or None
+    :return: text file object
+    """
+    if compress is None:
+        compress = str(filepath).lower().endswith(".gz")
+    if compress:
+        raw = io.BufferedWriter(gzip.GzipFile(filepath, "wb", mtime=0), BUFFER_SIZE)
+    else:
+        raw = open(filepath, "wb", buffering=BUFFER_SIZE)
+    return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+
+
+class JourneyExporter:
+    """
+    Streams journeys to a file as JSONL, CSV, or the text layout of the encounter
+    window. JSONL and CSV hold one record per day (see FIELDS), with None for a
+    time of day without an encounter, so they can be read back one day at a time.
+    Each journey is written as soon as it is given, so nothing is kept in memory
+    between calls.
+    """
+
+    def __init__(self, filepath, fmt=None, compress=None):
+        self.fmt = fmt or guess_format(filepath)
+        if self.fmt not in FORMATS:
+            raise ValueError(f"{self.fmt} is not one of {', '.join(FORMATS)}.")
+        self.fp = open_output(filepath, compress)
+        self.journeys = 0
+        self._csv = None
+        if self.fmt == "csv":
+            self._csv = csv.writer(self.fp)
+            self._csv.writerow(FIELDS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fp.close()
+
+    def write(self, segments: list, rows: np.ndarray, tables, seed=None, number=None,
+              rerolls=None):
+        """
+        Writes one journey rolled over segments, e.g. by journey.roll_seeded_rows.
+        :param segments: list of dict
+        :param rows: np.ndarray of shape (days, 3)
+        :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+        :param seed: int, the seed the journey was rolled from, if any
+        :param number: int, the journey number, if it is one of many
+        :param rerolls: np.ndarray of shape (days, 3), see journey.reroll
+        :return: None
+        """
+        self.write_many(segments, rows[None], tables, seed,
+                        None if number is None else [number],
+                        None if rerolls is None else rerolls[None])
+
+    def write_many(self, segments: list, rows: np.ndarray, tables, seed=None,
+                   numbers=None, rerolls=None):
+        """
+        Writes a batch of journeys rolled over the same segments. With a seed,
+        rolls on the sheets that encounters refer to are drawn from it too (see
+        journey.label_seeded_rows).
+        :param segments: list of dict
+        :param rows: np.ndarray of shape (journeys, days, 3)
+        :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+        :param seed: int, the seed the journeys were rolled from, if any
+        :param numbers: list of int, the journey numbers, if they are part of many
+        :param rerolls: np.ndarray of shape (journeys, days, 3), see journey.reroll
+        :return: None
+        """
+        if seed is None:
+            encounters = journey.label_rows(rows, segments, tables)
+        else:
+            encounters = journey.label_seeded_rows(
+                rows, segments, tables, seed,
+                np.arange(len(rows)) if numbers is None else numbers, rerolls)
+        chances, _, names = journey.day_settings(segments)
+        chances, names = chances.tolist(), names.tolist()
+        for i, rolled in enumerate(encounters):
+            number = None if numbers is None else int(numbers[i])
+            if self.fmt == "text":
+                if number is not None:
+                    self.fp.write(f"Journey {number}\n")
+                self.fp.writelines(journey.format_journey(segments, rolled, seed))
+            else:
+                self._write_days(number or 0, seed, names, chances, rolled.tolist())
+            self.journeys += 1
+
+    def _write_days(self, number, seed, names, chances, rolled):
+        days = zip(range(len(names)), names, chances, rolled)
+        if self.fmt == "csv":
+            self._csv.writerows((number, seed, day, name, chance, *encounters)
+                                for day, name, chance, encounters in days)
+            return
+        for day, name, chance, encounters in days:
+            record = dict(zip(FIELDS, (number, seed, day, name, chance, *encounters)))
+            self.fp.write(json.dumps(record) + "\n")
+
+
+def export_journeys(filepath, segments: list, tables, journeys: int, seed: int,
+                    fmt=None, compress=None, batch_size=BATCH_SIZE) -> int:
+    """
+    This function rolls journeys 0 to journeys - 1 over segments from seed (see
+    journey.roll_seeded_rows) and streams them to filepath. The journeys are
+    rolled and written batch_size at a time, so memory does not grow with the
+    number of journeys, and the file is the same whatever the batch size.
+    :param filepath: filepath
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param journeys: int
+    :param seed: int
+    :param fmt: str, one of FORMATS, or None to guess it from filepath
+    :param compress: bool, or None to compress when filepath ends in .gz
+    :param batch_size: int
+    :return: int: the number of journeys written
+    """
+    with JourneyExporter(filepath, fmt, compress) as exporter:
+        for start in range(0, journeys, batch_size):
+            numbers = np.arange(start, min(start + batch_size, journeys))
+            rows = journey.roll_seeded_rows(segments, tables, seed, numbers)
+            exporter.write_many(segments, rows, tables, seed, numbers)
+        return exporter.journeys
+
+
+if __name__ == "__main__":
+    import simulation
+
+    parser = argparse.ArgumentParser(
+        description="Roll journeys from a seed and stream them to a file.")
+    parser.add_argument("output", help="file to write; .jsonl, .csv, or .txt, "
+                                       "optionally followed by .gz")
+    parser.add_argument("leg", nargs="+", type=simulation.parse_leg,
+                        help='route legs in order, e.g. "Open Roads Tier0:5"')
+    parser.add_argument("--workbook", default="./samples/encounters.xlsx")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="output format (default: from the file name)")
+    parser.add_argument("--chance", type=int, default=10)
+    parser.add_argument("--no-daytime", dest="daytime", action="store_false")
+    parser.add_argument("--no-evening", dest="evening", action="store_false")
+    parser.add_argument("--night", action="store_true")
+    parser.add_argument("--journeys", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    route_segments = journey.segments_from_spec(
+        journey.route_spec(args.leg, args.chance, args.daytime, args.evening,
+                           args.night))
+    with backend.TableRegistry(list(dict.fromkeys(table for table, _ in args.leg)),
+                               args.workbook) as registry:
+        written = export_journeys(args.output, route_segments, registry, args.journeys,
+                                  args.seed, args.format, batch_size=args.batch_size)
+    print(f"Wrote {written} journeys to {args.output}")
@@ -0,0 +1,496 @@
+import numpy as np
+import backend
+import sampler
+
+TIMES_OF_DAY = ("daytime", "evening", "night")
+# Seeds for the slot streams are reduced to 64 bits.
+SEED_MASK = (1 << 64) - 1
+
+
+def make_spec(days: int, table: str, chance: int, daytime=True, evening=True,
+              night=False) -> list:
+    """
+    This function builds a journey spec that uses the same table, chance, and
+    times of day for every day of the journey. Day 0 is the day the party sets
+    out, so the spec covers days + 1 days, like the journey window.
+    :param days: int
+    :param table: str
+    :param chance: int, percentage chance of an encounter at each check
+    :param daytime: bool
+    :param evening: bool
+    :param night: bool
+    :return: list of dict
+    """
+    checks = tuple(time_of_day for time_of_day, wanted
+                   in zip(TIMES_OF_DAY, (daytime, evening, night)) if wanted)
+    return [{"table": table, "chance": chance, "checks": checks}
+            for _ in range(days + 1)]
+
+
+def route_spec(route: list, chance: int, daytime=True, evening=True,
+               night=False) -> list:
+    """
+    This function builds a journey spec from a route, a list of (table, days)
+    legs travelled in order, using the same chance and times of day throughout.
+    :param route: list of tuple of (str, int)
+    :param chance: int, percentage chance of an encounter at each check
+    :param daytime: bool
+    :param evening: bool
+    :param night: bool
+    :return: list of dict
+    """
+    spec = []
+    for table, days in route:
+        spec.extend(make_spec(days - 1, table, chance, daytime, evening, night))
+    return spec
+
+
+def make_segment(start: int, end: int, table: str, chance: int, daytime=True,
+                 evening=True, night=False) -> dict:
+    """
+    This function builds a journey segment: a run of days, from start to end
+    inclusive, that all use the same table, chance, and times of day.
+    :param start: int
+    :param end: int
+    :param table: str
+    :param chance: int, percentage chance of an encounter at each check
+    :param daytime: bool
+    :param evening: bool
+    :param night: bool
+    :return: dict
+    """
+    checks = tuple(time_of_day for time_of_day, wanted
+                   in zip(TIMES_OF_DAY, (daytime, evening, night)) if wanted)
+    return {"start": start, "end": end, "table": table, "chance": chance,
+            "checks": checks}
+
+
+def segments_from_spec(spec: list) -> list:
+    """
+    This function run-length encodes a journey spec, merging consecutive days that
+    use the same table, chance, and times of day into one segment.
+    :param spec: list of dict
+    :return: list of dict
+    """
+    segments = []
+    for day, plan in enumerate(spec):
+        last = segments[-1] if segments else None
+        if last is not None and last["table"] == plan["table"] \
+                and last["chance"] == plan["chance"] \
+                and last["checks"] == tuple(plan["checks"]):
+            last["end"] = day
+        else:
+            segments.append({"start": day, "end": day, "table": plan["table"],
+                             "chance": plan["chance"], "checks": tuple(plan["checks"])})
+    return segments
+
+
+def check_segments(segments: list):
+    """
+    This function raises a ValueError unless the segments cover the journey from
+    day 0 in order, without gaps or overlaps.
+    :param segments: list of dict
+    :return: None
+    """
+    if not segments:
+        raise ValueError("The journey has no segments.")
+    start = 0
+    for number, segment in enumerate(segments, 1):
+        if segment["start"] != start:
+            raise ValueError(f"Segment {number} starts on day {segment['start']} "
+                             f"instead of day {start}.")
+        if segment["end"] < segment["start"]:
+            raise ValueError(f"Segment {number} ends on day {segment['end']}, before "
+                             f"it starts on day {segment['start']}.")
+        start = segment["end"] + 1
+
+
+def segment_days(segments: list) -> np.ndarray:
+    """
+    This function returns the number of days in each segment.
+    :param segments: list of dict
+    :return: np.ndarray
+    """
+    return np.array([segment["end"] - segment["start"] + 1 for segment in segments],
+                    dtype=np.int64)
+
+
+def day_settings(segments: list, days=None) -> tuple:
+    """
+    This function repeats the chance, the times of day to check, and the table of
+    each segment over its days. It returns them as arrays of shape (days,),
+    (days, 3), and (days,); given an array of day numbers, it returns them for
+    those days instead, with that array's shape in place of (days,).
+    :param segments: list of dict
+    :param days: np.ndarray of int, or None for every day of the journey
+    :return: tuple of (np.ndarray, np.ndarray, np.ndarray)
+    """
+    chances = np.array([segment["chance"] for segment in segments], dtype=np.int64)
+    checked = np.array([[time_of_day in segment["checks"] for time_of_day in TIMES_OF_DAY]
+                        for segment in segments], dtype=bool)
+    checked = checked.reshape(len(segments), len(TIMES_OF_DAY))
+    names = np.array([segment["table"] for segment in segments], dtype=object)
+    if days is None:
+        index = np.repeat(np.arange(len(segments)), segment_days(segments))
+    else:
+        index = np.searchsorted([segment["end"] for segment in segments], days)
+    return chances[index], checked[index], names[index]
+
+
+def roll_segment_rows(segments: list, tables, count=1, rng=None) -> np.ndarray:
+    """
+    This function generates count journeys from a list of segments at once (see
+    make_segment and check_segments). The chance and times of day of each segment
+    are repeated over its days as arrays, so the cost does not depend on how the
+    journey is split up. Every encounter check is drawn as one array, and the rolls
+    on each table are drawn and resolved together with CompiledTable.roll_indices.
+    It returns an integer array of shape (count, days, 3) holding, for each
+    journey, day, and time of day, the row of that day's table that was rolled,
+    or -1 where there was no encounter.
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param count: int
+    :param rng: np.random.Generator
+    :return: np.ndarray
+    """
+    check_segments(segments)
+    rng = rng or np.random.default_rng()
+    chances, checked, names = day_settings(segments)
+    rolls = rng.integers(1, 100, size=(count,) + checked.shape, endpoint=True)
+    hits = (rolls <= chances[None, :, None]) & checked[None, :, :]
+
+    rows = np.full(hits.shape, -1, dtype=np.int64)
+    for name in dict.fromkeys(names):
+        mask = hits & (names == name)[None, :, None]
+        found = int(mask.sum())
+        if found:
+            rows[mask] = tables[name].roll_indices(found, rng)
+    return rows
+
+
+def roll_segment_rows_without_repeats(segments: list, tables, samplers=None,
+                                      cooldown=None, cooldown_weight=0.0,
+                                      rng=None) -> np.ndarray:
+    """
+    This function generates one journey like roll_segment_rows, but rolls on each
+    table with a sampler.TableSampler, so an encounter that has come up is not
+    rolled again (or, with a cooldown in days, is less likely until it has passed).
+    The samplers tick once a day. Pass the same samplers dict, keyed by table name,
+    to carry the used encounters over from one journey to the next in a campaign;
+    samplers for tables not in it yet are added to it.
+    It returns an integer array of shape (days, 3), like one journey of
+    roll_segment_rows.
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param samplers: dict of sampler.TableSampler, or None
+    :param cooldown: int, days before an encounter can come up as usual again, or
+        None to never repeat it until its table runs out
+    :param cooldown_weight: float, how likely a cooling encounter is, from 0 to 1
+    :param rng: np.random.Generator
+    :return: np.ndarray
+    """
+    check_segments(segments)
+    rng = rng or np.random.default_rng()
+    samplers = {} if samplers is None else samplers
+    chances, checked, names = day_settings(segments)
+    rolls = rng.integers(1, 100, size=checked.shape, endpoint=True)
+    hits = (rolls <= chances[:, None]) & checked
+
+    rows = np.full(hits.shape, -1, dtype=np.int64)
+    today = 0
+    for day, slot in zip(*(found.tolist() for found in np.nonzero(hits))):
+        if day != today:
+            for table_sampler in samplers.values():
+                table_sampler.tick(day - today)
+            today = day
+        name = names[day]
+        if name not in samplers:
+            samplers[name] = sampler.TableSampler(tables[name], cooldown,
+                                                  cooldown_weight, rng)
+        rows[day, slot] = samplers[name].roll_index()
+    # Tick through the rest of the journey, so the next one starts a day later.
+    for table_sampler in samplers.values():
+        table_sampler.tick(len(names) - today)
+    return rows
+
+
+def roll_journey_rows(spec: list, tables, count=1, rng=None) -> np.ndarray:
+    """
+    This function generates count journeys from a journey spec at once. The spec
+    is a list with one dict per day, holding the table name ("table"), the
+    percentage chance of an encounter ("chance"), and the times of day to check
+    ("checks", any of TIMES_OF_DAY). The spec is run-length encoded into segments
+    and rolled with roll_segment_rows, which gives the same results.
+    :param spec: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param count: int
+    :param rng: np.random.Generator
+    :return: np.ndarray
+    """
+    return roll_segment_rows(segments_from_spec(spec), tables, count, rng)
+
+
+def roll_segments(segments: list, tables, count=1, rng=None) -> np.ndarray:
+    """
+    This function generates count journeys from a list of segments (see
+    roll_segment_rows) and returns an object array of shape (count, days, 3)
+    holding the formatted encounter, or None, for each journey, day, and time of
+    day.
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param count: int
+    :param rng: np.random.Generator
+    :return: np.ndarray
+    """
+    return label_rows(roll_segment_rows(segments, tables, count, rng), segments, tables)
+
+
+def label_rows(rows: np.ndarray, segments: list, tables, rng=None,
+               keys=None) -> np.ndarray:
+    """
+    This function turns the rows rolled for one or more journeys over the same
+    segments, an array whose last two axes are (days, 3), into an object array of
+    the same shape holding the formatted encounter, or None. Rows that refer to
+    another sheet are rolled on it (see CompiledTable.resolve_labels), from rng,
+    or from keys, an array of random keys shaped like rows.
+    :param rows: np.ndarray
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param rng: np.random.Generator
+    :param keys: np.ndarray of np.uint64, or None
+    :return: np.ndarray
+    """
+    results = np.full(rows.shape, None, dtype=object)
+    _, _, names = day_settings(segments)
+    for name in dict.fromkeys(names):
+        mask = (rows >= 0) & (names == name)[:, None]
+        if mask.any():
+            results[mask] = tables[name].resolve_labels(
+                rows[mask], rng, None if keys is None else keys[mask])
+    return results
+
+
+def label_seeded_rows(rows: np.ndarray, segments: list, tables, seed: int, journeys=1,
+                      rerolls=None) -> np.ndarray:
+    """
+    This function labels journeys rolled by roll_seeded_rows, like label_rows.
+    Rolls on the sheets that rows refer to are drawn from each slot's own key, so
+    they are as reproducible as the journeys, and rerolling one slot leaves the
+    others alone.
+    :param rows: np.ndarray of shape (journeys, days, 3)
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param seed: int
+    :param journeys: int or array of int, as given to roll_seeded_rows
+    :param rerolls: array of int broadcastable to rows, or None
+    :return: np.ndarray
+    """
+    numbers = np.arange(journeys) if np.isscalar(journeys) else np.asarray(journeys)
+    keys = slot_keys(seed, numbers[:, None, None], np.arange(rows.shape[-2])[None, :, None],
+                     np.arange(len(TIMES_OF_DAY))[None, None, :],
+                     0 if rerolls is None else rerolls)
+    # The rows themselves were drawn from these keys (see roll_slots).
+    keys = backend.mix64(np.broadcast_to(keys, rows.shape) ^ np.uint64(1))
+    return label_rows(rows, segments, tables, keys=keys)
+
+
+def slot_keys(seed: int, journeys, days, slots, rerolls=0) -> np.ndarray:
+    """
+    This function returns the random key of each encounter slot: one time of day
+    (slot, an index into TIMES_OF_DAY) on one day of one journey, rolled for the
+    rerolls-th time. The key is a hash of those numbers and the seed rather than a
+    position in a shared stream, so any slot can be rolled on its own, in any order
+    or process, and always gives the same result. The arguments are broadcast
+    together.
+    :param seed: int
+    :param journeys: int or array of int, journey numbers
+    :param days: int or array of int
+    :param slots: int or array of int
+    :param rerolls: int or array of int
+    :return: np.ndarray of np.uint64
+    """
+    return counter_keys(seed, journeys, days, slots, rerolls)
+
+
+def counter_keys(seed: int, *counters) -> np.ndarray:
+    """
+    This function hashes a seed and any number of counters into random 64-bit
+    keys, one for each element of the broadcast counters. Each counter is mixed in
+    before the next one is broadcast in, so leading counters are cheap.
+    :param seed: int
+    :param counters: int or array of int
+    :return: np.ndarray of np.uint64
+    """
+    key = backend.mix64(np.asarray(seed & SEED_MASK, dtype=np.uint64))
+    for counter in counters:
+        key = backend.mix64(key ^ np.asarray(counter, dtype=np.int64).astype(np.uint64))
+    return key
+
+
+def roll_slots(segments: list, tables, seed: int, journeys, days, slots,
+               rerolls=0) -> np.ndarray:
+    """
+    This function rolls the given encounter slots (see slot_keys), using the table,
+    chance, and times of day of the segment each day falls in. The encounter check
+    and the roll on the table are drawn from two values derived from the slot's
+    key, so a slot's result never depends on which other slots are rolled with it.
+    It returns the row of the table rolled for each slot, or -1 where there was no
+    encounter, in the broadcast shape of the arguments.
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param seed: int
+    :param journeys: int or array of int, journey numbers
+    :param days: int or array of int
+    :param slots: int or array of int
+    :param rerolls: int or array of int
+    :return: np.ndarray
+    """
+    check_segments(segments)
+    # The keys are hashed before broadcasting, so each stage of the hash only
+    # works over the counters it has seen so far.
+    keys = slot_keys(seed, journeys, days, slots, rerolls)
+    days, slots = np.broadcast_arrays(np.asarray(days, dtype=np.int64),
+                                      np.asarray(slots, dtype=np.int64))
+    keys, days, slots = np.broadcast_arrays(keys, days, slots)
+    ends = np.array([segment["end"] for segment in segments], dtype=np.int64)
+    if days.size and (days.min() < 0 or days.max() > ends[-1]):
+        raise ValueError(f"The journey only has days 0 to {ends[-1]}.")
+    chances, checked, names = day_settings(segments, days)
+    checked = np.take_along_axis(checked, slots[..., None], axis=-1)[..., 0]
+
+    checks = (backend.mix64(keys) % np.uint64(100)).astype(np.int64) + 1
+    hits = (checks <= chances) & checked
+    rows = np.full(keys.shape, -1, dtype=np.int64)
+    for name in dict.fromkeys(names[hits]):
+        mask = hits & (names == name)
+        rows[mask] = tables[name].key_indices(backend.mix64(keys[mask] ^ np.uint64(1)))
+    return rows
+
+
+def roll_seeded_rows(segments: list, tables, seed: int, journeys=1,
+                     rerolls=None) -> np.ndarray:
+    """
+    This function generates journeys like roll_segment_rows, but every slot is
+    rolled from its own stream (see roll_slots). The same seed always regenerates
+    the same journeys, and journeys can be generated in any batches, e.g. split
+    across workers by journey number, without changing the results.
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param seed: int
+    :param journeys: int, the number of journeys to roll starting from journey 0,
+        or an array of journey numbers
+    :param rerolls: array of int broadcastable to (journeys, days, 3), the number of
+        times each slot has been rerolled, or None
+    :return: np.ndarray of shape (journeys, days, 3)
+    """
+    check_segments(segments)
+    numbers = np.arange(journeys) if np.isscalar(journeys) else np.asarray(journeys)
+    days = int(segment_days(segments).sum())
+    return roll_slots(segments, tables, seed, numbers[:, None, None],
+                      np.arange(days)[None, :, None],
+                      np.arange(len(TIMES_OF_DAY))[None, None, :],
+                      0 if rerolls is None else rerolls)
+
+
+def reroll(rows: np.ndarray, rerolls: np.ndarray, segments: list, tables, seed: int,
+           day: int, slot=None, journey=0):
+    """
+    This function rerolls one slot, or every slot of one day, of a journey rolled
+    by roll_seeded_rows, updating rows and the reroll counts in place. Only those
+    slots are rolled again; the rest of the journey is untouched, and rolling the
+    journey again with the same seed and reroll counts gives the same result.
+    :param rows: np.ndarray of shape (days, 3), one journey from roll_seeded_rows
+    :param rerolls: np.ndarray of int of shape (days, 3)
+    :param segments: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param seed: int
+    :param day: int
+    :param slot: int, an index into TIMES_OF_DAY, or None for the whole day
+    :param journey: int, the journey number
+    :return: None
+    """
+    if not 0 <= day < len(rows):
+        raise ValueError(f"Day {day} is not part of the journey, which runs from day 0 "
+                         f"to day {len(rows) - 1}.")
+    slots = np.arange(len(TIMES_OF_DAY)) if slot is None else np.array([slot])
+    counts = rerolls[day, slots] + 1
+    # Nothing is written until the slots have rolled, so a failure leaves the
+    # journey as it was.
+    rows[day, slots] = roll_slots(segments, tables, seed, journey, day, slots, counts)
+    rerolls[day, slots] = counts
+
+
+def roll_journeys(spec: list, tables, count=1, rng=None) -> np.ndarray:
+    """
+    This function generates count journeys from a journey spec (see
+    roll_journey_rows) and returns an object array of shape (count, days, 3)
+    holding the formatted encounter, or None, for each journey, day, and time of
+    day.
+    :param spec: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param count: int
+    :param rng: np.random.Generator
+    :return: np.ndarray
+    """
+    return roll_segments(segments_from_spec(spec), tables, count, rng)
+
+
+def generate_journeys(spec: list, tables, count=1, rng=None) -> list:
+    """
+    This function generates count journeys from a journey spec (see
+    roll_journeys) and returns them in the structure used by the encounter
+    window: a dict per journey keyed by day number, each day a dict holding the
+    table, the chance, and the encounter (or None) for daytime, evening, and night.
+    :param spec: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry
+    :param count: int
+    :param rng: np.random.Generator
+    :return: list of dict
+    """
+    results = roll_journeys(spec, tables, count, rng)
+    journeys = []
+    for rolled in results.tolist():
+        journey = {}
+        for day, (plan, encounters) in enumerate(zip(spec, rolled)):
+            journey[day] = {"table": plan["table"], "chance": plan["chance"]}
+            journey[day].update(zip(TIMES_OF_DAY, encounters))
+        journeys.append(journey)
+    return journeys
+
+
+def format_journey(segments: list, encounters: np.ndarray, seed=None) -> list:
+    """
+    This function writes out one journey rolled by roll_segments, segment by
+    segment. Each segment gets a heading, then a line for every day that had an
+    encounter; quiet days are only counted, so months-long journeys stay readable.
+    :param segments: list of dict
+    :param encounters: np.ndarray of shape (days, 3), one journey from roll_segments
+        or label_rows
+    :param seed: int, the seed the journey was rolled from, if any
+    :return: list of str, lines ending in a newline
+    """
+    lines = ["Reminder: Day 0 is the day the party sets out.\n\n"]
+    if seed is not None:
+        lines.insert(0, f"Seed: {seed}\n")
+    for segment in segments:
+        start, end = segment["start"], segment["end"]
+        days = f"Day {start}" if start == end else f"Days {start}-{end}"
+        checks = ", ".join(segment["checks"]) or "nothing"
+        lines.append(f"{days}: Location Type: {segment['table']}. "
+                     f"{segment['chance']}% chance, checking {checks}.\n")
+        quiet = 0
+        for day in range(start, end + 1):
+            rolled = encounters[day]
+            if all(encounter is None for encounter in rolled):
+                quiet += 1
+                continue
+            found = ". ".join(f"{time_of_day.capitalize()}: {encounter or 'Nothing'}"
+                              for time_of_day, encounter in zip(TIMES_OF_DAY, rolled))
+            lines.append(f"    Day {day}: {found}.\n")
+        if quiet == end - start + 1:
+            lines.append("    No encounters.\n")
+        elif quiet:
+            lines.append(f"    No encounters on {quiet} other "
+                         f"{'day' if quiet == 1 else 'days'}.\n")
+        lines.append("\n")
+    return lines
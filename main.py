@@ -1,10 +1,25 @@
-import random
+import logging
+import os
+import secrets
 
 import PySimpleGUI as sg
+import numpy as np
 import pandas as pd
 import backend
+import export
+import journey as journeys
+import metrics
+import watcher
 
 sg.theme("Black")
+logger = logging.getLogger(__name__)
+
+# The terrain every day of a new journey starts with. It is loaded first.
+DEFAULT_TERRAIN = "Country Shire Tier0"
+# The journey window only builds this many segment rows and pages through the rest.
+SEGMENTS_PER_PAGE = 7
+# Days in a segment added with the Add Segment button.
+NEW_SEGMENT_DAYS = 7
 
 
 def make_main_window():
@@ -38,40 +53,62 @@ def make_main_window():
                                  enable_events=True,
                                  visible=True,
                                  default_text="7",
-                                 size=2,
-                                 tooltip="Use blocks of 7 days for very long trips.")
+                                 size=4,
+                                 tooltip="Split long trips into segments in the "
+                                         "journey window.")
     days_layout = [[days_choice_label, days_choice_input]]
     days_frame = sg.Frame("Travel Days", layout=days_layout)
 
+    # The tables are loaded and validated in the background after Next Step.
+    load_bar = sg.ProgressBar(1, orientation="h", size=(30, 10), key="load bar")
+    load_status = sg.Text("", size=(45, 1), key="load status")
+    watch_checkbox = sg.Checkbox("Watch for Changes", default=False,
+                                 tooltip="Load tables again as soon as the workbook "
+                                         "or the table list is saved, reading only "
+                                         "the sheets that changed",
+                                 key="watch")
+    load_layout = [[load_bar], [load_status], [watch_checkbox]]
+    load_frame = sg.Frame("Workbook Status", layout=load_layout)
+
     # This is the bottom row of command buttons.
     exit_button = sg.Button("Exit", key="exit")
     next_button = sg.Button("Next Step", key="next")
     bottom_row_layout = [[exit_button, next_button]]
 
-    main_layout = [[wb_frame], [json_frame], [days_frame], [bottom_row_layout]]
+    main_layout = [[wb_frame], [json_frame], [days_frame], [load_frame],
+                   [bottom_row_layout]]
     return sg.Window("Random Encounter Generator", layout=main_layout,
                      finalize=True)
 
 
-def make_journey_window(days: int, tables: list) -> sg.Window:
+def make_journey_window(tables: list) -> sg.Window:
     """
-    This function creates a window that allows the user to pick the types of terrain
-    that the party will pass through on their journey, using the number of days to
-    create frames for each section. Each section also allows the GM to choose the
-    percentage chance of an encounter. The types of encounters will be found in the
-    encounter workbook, the tables in tables.json.
-    It is best to keep the number to 7 days at a time to keep the window size from
-    growing too large.
-    :param days:
+    This function creates a window that allows the user to split the journey into
+    segments, runs of days through the same type of terrain, and to pick the table,
+    the percentage chance of an encounter, and the times of day to check for each
+    segment. The types of encounters will be found in the encounter workbook, the
+    tables in tables.json.
+    Only SEGMENTS_PER_PAGE segment rows are built; longer journeys are paged
+    through them (see show_page and save_page), so the window stays the same size
+    however long the journey is.
     :param tables: list of str
-    :return:
+    :return: sg.Window
     """
     layout = []
-    for day in range(days + 1):
-        # Day 0 is an encounter near the starting point, like in a city or town on
-        # the way out of town.
-        frame = make_journey_row(day, tables)
-        layout.append([frame])
+    for row in range(SEGMENTS_PER_PAGE):
+        layout.append([sg.pin(make_journey_row(row, tables))])
+
+    previous_button = sg.Button("<", tooltip="Previous page of segments",
+                                key="previous page")
+    page_label = sg.Text("", size=14, justification="center", key="page")
+    next_button = sg.Button(">", tooltip="Next page of segments", key="next page")
+    add_button = sg.Button("Add Segment",
+                           tooltip=f"Add {NEW_SEGMENT_DAYS} more days at the end "
+                                   f"of the journey",
+                           key="add segment")
+    remove_button = sg.Button("Remove Segment", tooltip="Remove the last segment",
+                              key="remove segment")
+    layout.append([previous_button, page_label, next_button, add_button, remove_button])
 
     close_button = sg.Button("Close",
                              tooltip="Closes this window. Not recommended while working.",
@@ -79,66 +116,146 @@ def make_journey_window(days: int, tables: list) -> sg.Window:
     create_button = sg.Button("Create Encounters",
                               tooltip="Generate a list of encounters or reroll the current one",
                               key="create encounters")
-    bottom_row_layout = [close_button, create_button]
+    seed_label = sg.Text("Seed:")
+    seed_input = sg.Input(default_text="", size=20,
+                          tooltip="Leave blank for a new journey every time, or enter "
+                                  "the seed of an earlier journey to roll it again",
+                          key="seed")
+    no_repeats_checkbox = sg.Checkbox("No Repeats", default=False,
+                                      tooltip="Never roll the same encounter twice on "
+                                              "this journey, unless its table runs out",
+                                      key="no repeats")
+    bottom_row_layout = [close_button, create_button, seed_label, seed_input,
+                         no_repeats_checkbox]
     layout.append(bottom_row_layout)
     return sg.Window("Journey Window", layout=layout, finalize=True)
 
 
-def make_journey_row(day: int, tables) -> sg.Frame:
+def make_journey_row(row: int, tables) -> sg.Frame:
     """
-    This function creates a Frame for each segment of the journey, allowing the user
-    to enter a percentage chance of an encounter for each segment, to choose a
-    table to use for that segment, and the number of times per day to check.
-    :param day:
-    :return:
+    This function creates a Frame for one row of segments in the journey window,
+    allowing the user to enter the last day of the segment, a percentage chance of
+    an encounter, to choose a table to use for that segment, and the number of
+    times per day to check. The segment shown in the row changes with the page.
+    :param row: int
+    :param tables: list of str
+    :return: sg.Frame
     """
-    frame_label = f"Day {day} of Journey"
+    days_label = sg.Text("", size=18, key=f"first day{row}")
+    end_input = sg.Input(default_text="", enable_events=True, size=4,
+                         tooltip="Last day of this segment",
+                         key=f"last day{row}")
     terrain_label = sg.Text("Choose Terrain and Tier Level")
-    terrain_listbox = sg.Combo(tables, enable_events=True, default_value="Country Shire Tier0",
-                               visible=True, key=f"terrain choice{day}")
+    terrain_listbox = sg.Combo(tables, enable_events=True, default_value=DEFAULT_TERRAIN,
+                               visible=True, key=f"terrain choice{row}")
     chance_label = sg.Text("Encounter Chance (%):")
-    chance_input = sg.Input(default_text="10", enable_events=True, size=2,
+    chance_input = sg.Input(default_text="10", enable_events=True, size=3,
                             tooltip="Indicate a percentage change of encounter",
-                            key=f"chance{day}")
+                            key=f"chance{row}")
     frequency_label = sg.Text("Frequency Each Day: ")
     daytime_checkbox = sg.Checkbox("Daytime", default=True, tooltip="Every Morning?",
-                                   enable_events=True, key=f"daytime{day}")
+                                   enable_events=True, key=f"daytime{row}")
     evening_checkbox = sg.Checkbox("Evening", default=True, tooltip="Every Evening?",
-                                   enable_events=True, key=f"evening{day}")
+                                   enable_events=True, key=f"evening{row}")
     night_checkbox = sg.Checkbox("Night", default=False, tooltip="Every Night During Sleep?",
-                                 enable_events=True, key=f"night{day}")
-    frame_layout = [[terrain_label, terrain_listbox, chance_label, chance_input],
-                    [frequency_label, daytime_checkbox, evening_checkbox,night_checkbox]]
-    return sg.Frame(frame_label, layout=frame_layout)
+                                 enable_events=True, key=f"night{row}")
+    frame_layout = [[days_label, end_input, terrain_label, terrain_listbox],
+                    [chance_label, chance_input, frequency_label, daytime_checkbox,
+                     evening_checkbox, night_checkbox]]
+    return sg.Frame("", layout=frame_layout, key=f"segment{row}")
+
+
+def page_count(segments: list) -> int:
+    """
+    This function returns the number of pages the journey window needs to show
+    every segment.
+    :param segments: list of dict
+    :return: int
+    """
+    return max(1, -(-len(segments) // SEGMENTS_PER_PAGE))
+
+
+def show_page(window: sg.Window, segments: list, page: int):
+    """
+    This function fills the segment rows of the journey window with one page of
+    segments and hides the rows past the last segment.
+    :param window: sg.Window
+    :param segments: list of dict
+    :param page: int
+    :return: None
+    """
+    for row in range(SEGMENTS_PER_PAGE):
+        index = page * SEGMENTS_PER_PAGE + row
+        if index >= len(segments):
+            window[f"segment{row}"].update(visible=False)
+            continue
+        segment = segments[index]
+        window[f"segment{row}"].update(value=f"Segment {index + 1}", visible=True)
+        window[f"first day{row}"].update(value=f"From day {segment['start']} to day")
+        window[f"last day{row}"].update(value=str(segment["end"]))
+        window[f"terrain choice{row}"].update(value=segment["table"])
+        window[f"chance{row}"].update(value=str(segment["chance"]))
+        for time_of_day in journeys.TIMES_OF_DAY:
+            window[f"{time_of_day}{row}"].update(value=time_of_day in segment["checks"])
+    window["page"].update(value=f"Page {page + 1} of {page_count(segments)}")
+    window["previous page"].update(disabled=page == 0)
+    window["next page"].update(disabled=page + 1 >= page_count(segments))
+
+
+def save_page(values: dict, segments: list, page: int):
+    """
+    This function reads the page of segments shown in the journey window back into
+    segments. Each segment then starts the day after the one before it ends, so
+    changing the last day of a segment moves the start of the next one. Raises a
+    ValueError, leaving segments as they were, if a number cannot be read or the
+    segments would no longer fit together.
+    :param values: dict
+    :param segments: list of dict
+    :param page: int
+    :return: None
+    """
+    edited = [dict(segment) for segment in segments]
+    for row in range(SEGMENTS_PER_PAGE):
+        index = page * SEGMENTS_PER_PAGE + row
+        if index >= len(edited):
+            break
+        try:
+            end = int(values[f"last day{row}"])
+            chance = int(values[f"chance{row}"])
+        except ValueError:
+            raise ValueError(f"Segment {index + 1} needs a whole number for its last "
+                             f"day and its chance.") from None
+        edited[index].update(
+            end=end, chance=chance, table=values[f"terrain choice{row}"],
+            checks=tuple(time_of_day for time_of_day in journeys.TIMES_OF_DAY
+                         if values[f"{time_of_day}{row}"]))
+    start = 0
+    for segment in edited:
+        segment["start"] = start
+        start = segment["end"] + 1
+    journeys.check_segments(edited)
+    for segment, changed in zip(segments, edited):
+        segment.update(changed)
 
 
-def make_encounter_window(days, encounters: dict) -> sg.Window:
+def make_encounter_window(lines: list, days: int) -> sg.Window:
     """
-    This function requires a dictionary structured the way that the default dict
-    is structured. It will use day numbers as keys for the day, then day subdicts
-    to provide details for table source and actual encounters by time of day.
-    :param days: int
-    :param encounters: dict
+    This function shows a journey written out by journey.format_journey. The lines
+    go into a single scrolling text box rather than a frame per day, so even
+    months-long journeys open quickly.
+    :param lines: list of str
+    :param days: int, the last day of the journey
     :return: sg.Window
     """
-    layout = []
-    for day in range(days + 1):
-        frame_label = f"Encounters for Day{day}"
-        if encounters[day]['daytime'] is None:
-            daytime_enc = sg.Text(f"Daytime: Nothing.  ")
-        else:
-            daytime_enc = sg.Text(f"Daytime: {encounters[day]['daytime']}  ")
-        if encounters[day]['evening'] is None:
-            evening_enc = sg.Text(f"Evening: Nothing.  ")
-        else:
-            evening_enc = sg.Text(f"Evening: {encounters[day]['evening']}  ")
-        if encounters[day]['night'] is None:
-            night_enc = sg.Text(f"Night: Nothing  ")
-        else:
-            night_enc = sg.Text(f"Night: {encounters[day]['night']}  ")
-        source = sg.Text(f"Source: {encounters[day]['table']}")
-        frame_layout = [[daytime_enc, evening_enc, night_enc, source]]
-        layout.append([sg.Frame(frame_label, layout=frame_layout)])
+    layout = [[sg.Multiline("".join(lines), size=(100, 30), disabled=True,
+                            key="encounter text")]]
+
+    reroll_label = sg.Text("Reroll day:")
+    reroll_input = sg.Input(default_text="", size=4,
+                            tooltip="Day to roll again, leaving the others as they are",
+                            key="reroll day")
+    reroll_button = sg.Button("Reroll", key="reroll")
+    layout.append([reroll_label, reroll_input, reroll_button])
 
     write_frame_label = "Where would you like to write this data?"
     write_location = sg.Input(default_text="./output",
@@ -151,6 +268,8 @@ def make_encounter_window(days, encounters: dict) -> sg.Window:
                                        target="folder choice")
     output_file_label = sg.Text("File name for output:")
     output_file_choice = sg.InputText(default_text=f"encounters-Day0-{days}.txt",
+                                      tooltip="Ends in .txt, .jsonl, or .csv; add .gz "
+                                              "to compress the file",
                                       enable_events=True,
                                       key="filename")
     write_frame_layout = [[directory_button, write_location],
@@ -173,13 +292,120 @@ def make_encounter_window(days, encounters: dict) -> sg.Window:
                      finalize=True)
 
 
+def start_loader(window: sg.Window, workbook: backend.TableRegistry,
+                 first=()) -> backend.BackgroundLoader:
+    """
+    This function starts loading and validating every table of the workbook on a
+    worker thread. Progress is sent to window as "load progress" events holding
+    the loader itself followed by (name, done, total, failure), so that events
+    from a cancelled loader can be told apart.
+    :param window: sg.Window
+    :param workbook: backend.TableRegistry
+    :param first: list of str, tables to load before the others
+    :return: backend.BackgroundLoader
+    """
+    loader = None
+
+    def report(*progress):
+        window.write_event_value("load progress", (loader,) + progress)
+
+    loader = backend.BackgroundLoader(workbook, report, first)
+    return loader.start()
+
+
+def start_watcher(window: sg.Window, workbook: backend.TableRegistry,
+                  tables_path) -> watcher.WorkbookWatcher:
+    """
+    This function starts watching the workbook and the table list for changes.
+    Each time they are saved, the sheets that changed are loaded again on a worker
+    thread, and window gets a "workbook changed" event holding the watcher itself
+    followed by the new registry and the names of the sheets that changed.
+    :param window: sg.Window
+    :param workbook: backend.TableRegistry
+    :param tables_path: filepath of the table list
+    :return: watcher.WorkbookWatcher
+    """
+    workbook_watcher = None
+
+    def report(registry, changed):
+        window.write_event_value("workbook changed", (workbook_watcher, registry, changed))
+
+    workbook_watcher = watcher.WorkbookWatcher(workbook, tables_path, report)
+    return workbook_watcher.start()
+
+
+def read_seed(values: dict) -> int:
+    """
+    This function reads the seed from the journey window, picking a new one if it
+    was left blank. Raises a ValueError if it is not a whole number.
+    :param values: dict
+    :return: int
+    """
+    text = values["seed"].strip()
+    if not text:
+        return secrets.randbits(63)
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(f"The seed must be a whole number, not {text}.") from None
+
+
+def create_journey(segments: list, workbook, seed: int, no_repeats=False):
+    """
+    This function rolls the encounters of one journey from seed (see
+    journey.roll_seeded_rows, or journey.roll_segment_rows_without_repeats if
+    no_repeats is True), showing an error and returning None if one of its tables
+    failed validation.
+    :param segments: list of dict
+    :param workbook: backend.TableRegistry
+    :param seed: int
+    :param no_repeats: bool
+    :return: np.ndarray of shape (days, 3) or None
+    """
+    try:
+        if no_repeats:
+            rows = journeys.roll_segment_rows_without_repeats(
+                segments, workbook, rng=np.random.default_rng(seed))
+        else:
+            rows = journeys.roll_seeded_rows(segments, workbook, seed)[0]
+    except ValueError as e:
+        sg.popup_error(str(e), title="Workbook Problem")
+        return None
+    logger.debug("journey: %s", rows)
+    return rows
+
+
+def journey_lines(segments: list, workbook, seed: int, rows, rerolls) -> list:
+    """
+    This function writes out a journey rolled by create_journey.
+    :param segments: list of dict
+    :param workbook: backend.TableRegistry
+    :param seed: int
+    :param rows: np.ndarray of shape (days, 3)
+    :param rerolls: np.ndarray of shape (days, 3)
+    :return: list of str
+    """
+    encounters = journeys.label_seeded_rows(rows[None], segments, workbook, seed,
+                                            rerolls=rerolls[None])[0]
+    return journeys.format_journey(segments, encounters, seed)
+
+
 def main():
     main_window, journey_window, encounter_window = make_main_window(), None, None
-    print(main_window)
+    workbook, loader, workbook_watcher = None, None, None
+    # The journey being edited, and the page of it shown in the journey window.
+    segments, page = [], 0
+    # The journey in the encounter window: its segments, seed, whether it was
+    # rolled without repeats, the rows rolled, and how often each slot has been
+    # rerolled.
+    rolled, seed, no_repeats, rows, rerolls = None, None, False, None, None
+    # A journey (segments, seed, no repeats) waiting for its tables to finish
+    # loading in the background.
+    pending = None
 
     while True:
         window, event, values = sg.read_all_windows()
-        print(window, event, values)
+        logger.debug("%s %s %s", window, event, values)
 
         if event == sg.WIN_CLOSED and window == main_window:
             break
@@ -189,50 +415,194 @@ def main():
             encounter_window.close()
 
         match event:
+            case "workbook filepath" | "json filepath":
+                # A different file is being picked, so the tables being loaded
+                # and the journey built from them are out of date.
+                if loader is not None and not loader.cancelled:
+                    loader.cancel()
+                    main_window["load status"].update("Loading cancelled.")
+                if workbook_watcher is not None:
+                    workbook_watcher.cancel()
+                    workbook_watcher = None
+                if journey_window is not None:
+                    journey_window.close()
+                pending = None
+
             case "next":
                 if journey_window != sg.WIN_CLOSED:
                     journey_window.close()
                 tables = backend.import_tables(values["json filepath"])
                 tables.sort()
-                workbook = backend.import_workbook(tables, values["workbook filepath"])
+                if workbook_watcher is not None:
+                    workbook_watcher.cancel()
+                    workbook_watcher = None
+                if loader is not None:
+                    loader.cancel(close=True)
+                elif workbook is not None:
+                    workbook.close()
+                # Sheets are loaded and validated in the background, starting with
+                # the default terrain, and on demand if they are needed sooner.
+                workbook = backend.TableRegistry(tables, values["workbook filepath"])
+                loader = start_loader(main_window, workbook, first=[DEFAULT_TERRAIN])
+                if values["watch"]:
+                    workbook_watcher = start_watcher(main_window, workbook,
+                                                     values["json filepath"])
+                main_window["load bar"].update(current_count=0, max=len(tables))
+                main_window["load status"].update("Loading tables...")
+                pending = None
                 days = int(values["days choice"])
-                journey_window = make_journey_window(days, tables)
-                print(f"days: {days}. tables: {tables}")
-                print(f"workbook: {workbook}")
+                # A new journey is one segment; the user splits it up from there.
+                segments, page = [journeys.make_segment(0, days, DEFAULT_TERRAIN, 10)], 0
+                journey_window = make_journey_window(tables)
+                show_page(journey_window, segments, page)
+                logger.debug("days: %s. tables: %s", days, tables)
+                logger.debug("workbook: %s", workbook)
+
+            case "workbook changed":
+                source, registry, changed = values[event]
+                if source is not workbook_watcher:
+                    registry.close()
+                    continue
+                # The new registry already holds every table that was loaded;
+                # the loader only has to finish the rest.
+                loader.cancel(close=True)
+                tables_changed = set(registry.tables) != set(workbook.tables)
+                workbook = registry
+                loader = start_loader(main_window, workbook)
+                main_window["load bar"].update(current_count=0, max=len(workbook.tables))
+                main_window["load status"].update(
+                    f"Reloaded {len(changed)} changed tables.")
+                if (tables_changed and journey_window is not None
+                        and not journey_window.was_closed()):
+                    tables = sorted(workbook.tables)
+                    for row in range(SEGMENTS_PER_PAGE):
+                        journey_window[f"terrain choice{row}"].update(values=tables)
+                    show_page(journey_window, segments, page)
+                if (encounter_window is not None and not encounter_window.was_closed()
+                        and any(segment["table"] in changed for segment in rolled)):
+                    # Its rows were rolled on tables that are gone now.
+                    encounter_window.close()
+                    sg.popup_error("The encounters were rolled on tables that have "
+                                   "changed. Create them again.",
+                                   title="Workbook Changed", non_blocking=True)
+
+            case "load progress":
+                source, name, done, total, failure = values[event]
+                if source is not loader:
+                    continue
+                main_window["load bar"].update(current_count=done, max=total)
+                if name is None:
+                    failures = [workbook.failure(table) for table in workbook.tables
+                                if workbook.failure(table) is not None]
+                    main_window["load status"].update(
+                        f"Loaded {done - len(failures)} of {total} tables.")
+                    if failures:
+                        sg.popup_error("The following tables are improperly formatted.",
+                                       *failures, title="Workbook Problem",
+                                       non_blocking=True)
+                elif failure is not None:
+                    main_window["load status"].update(f"{name} failed validation.")
+                else:
+                    main_window["load status"].update(f"Loaded {name} ({done}/{total}).")
+                # Once the loader stops, whatever it did not reach is loaded here.
+                if pending is not None and (name is None or all(
+                        workbook.is_loaded(segment["table"])
+                        or workbook.failure(segment["table"]) is not None
+                        for segment in pending[0])):
+                    (rolled, seed, no_repeats), pending = pending, None
+                    rows = create_journey(rolled, workbook, seed, no_repeats)
+                    if rows is not None:
+                        rerolls = np.zeros_like(rows)
+                        lines = journey_lines(rolled, workbook, seed, rows, rerolls)
+                        encounter_window = make_encounter_window(lines, rolled[-1]["end"])
+
+            case str() if event.startswith("terrain choice"):
+                failure = workbook.failure(values[event])
+                if failure is not None:
+                    sg.popup_error(failure, title="Workbook Problem")
+                elif loader is not None:
+                    loader.prioritize(values[event])
+
+            case "previous page" | "next page" | "add segment" | "remove segment":
+                try:
+                    save_page(values, segments, page)
+                except ValueError as e:
+                    sg.popup_error(str(e), title="Journey Problem")
+                    continue
+                if event == "add segment":
+                    last = segments[-1]
+                    segments.append(dict(last, start=last["end"] + 1,
+                                         end=last["end"] + NEW_SEGMENT_DAYS))
+                    page = page_count(segments) - 1
+                elif event == "remove segment" and len(segments) > 1:
+                    segments.pop()
+                    page = min(page, page_count(segments) - 1)
+                elif event == "previous page":
+                    page = max(page - 1, 0)
+                elif event == "next page":
+                    page = min(page + 1, page_count(segments) - 1)
+                show_page(journey_window, segments, page)
 
             case "create encounters":
                 if encounter_window != sg.WIN_CLOSED:
                     encounter_window.close()
-                journey = {}
-                for day in range(days + 1):
-                    journey[day] = {}
-                    journey[day]["table"] = values[f"terrain choice{day}"]
-                    journey[day]["chance"] = int(values[f"chance{day}"])
-                    table = workbook[journey[day]["table"]]
-                    for time_of_day in ("daytime", "evening", "night"):
-                        roll = random.randint(1, 100)
-                        if roll <= journey[day]["chance"]:
-                            result = backend.roll_result(table)
-                        else:
-                            result = None
-                        journey[day][time_of_day] = result
-                print(journey)
-
-                encounter_window = make_encounter_window(days, journey)
+                try:
+                    save_page(values, segments, page)
+                    new_seed = read_seed(values)
+                except ValueError as e:
+                    sg.popup_error(str(e), title="Journey Problem")
+                    continue
+                show_page(journey_window, segments, page)
+                unknown = [segment["table"] for segment in segments
+                           if segment["table"] not in workbook]
+                if unknown:
+                    sg.popup_error(f"{unknown[0]} is not one of the tables in the "
+                                   f"table list.", title="Journey Problem")
+                    continue
+                waiting = [segment["table"] for segment in segments
+                           if not workbook.is_loaded(segment["table"])
+                           and workbook.failure(segment["table"]) is None]
+                if waiting and loader is not None and not loader.cancelled:
+                    # The journey is created once the loader reaches its tables.
+                    for table in reversed(dict.fromkeys(waiting)):
+                        loader.prioritize(table)
+                    pending = ([dict(segment) for segment in segments], new_seed,
+                               values["no repeats"])
+                    main_window["load status"].update("Waiting for tables to load...")
+                    continue
+                rolled, seed = [dict(segment) for segment in segments], new_seed
+                no_repeats = values["no repeats"]
+                rows = create_journey(rolled, workbook, seed, no_repeats)
+                if rows is not None:
+                    rerolls = np.zeros_like(rows)
+                    lines = journey_lines(rolled, workbook, seed, rows, rerolls)
+                    encounter_window = make_encounter_window(lines, rolled[-1]["end"])
+
+            case "reroll":
+                if no_repeats:
+                    # Every roll depends on the ones before it, so one day cannot
+                    # be rolled again on its own.
+                    sg.popup_error("Single days cannot be rerolled on a journey "
+                                   "without repeats. Create the encounters again.",
+                                   title="Journey Problem")
+                    continue
+                try:
+                    day = int(values["reroll day"])
+                    journeys.reroll(rows, rerolls, rolled, workbook, seed, day)
+                except ValueError as e:
+                    sg.popup_error(str(e), title="Journey Problem")
+                    continue
+                lines = journey_lines(rolled, workbook, seed, rows, rerolls)
+                encounter_window["encounter text"].update(value="".join(lines))
 
             case "write":
                 folder = values["folder choice"]
                 filename = values["filename"]
                 filepath = f"{folder}/{filename}"
-                lines = ["Reminder: Day 0 is the day the party sets out.\n\n"]
-                for day in range(days + 1):
-                    line1 = f"Day {day}: Location Type: {journey[day]['table']}\n"
-                    line2 = f"Daytime: {journey[day]['daytime']}. " \
-                            f"Evening: {journey[day]['evening']}. " \
-                            f"Night: {journey[day]['night']}.\n\n"
-                    lines.extend([line1, line2])
-                with open(filepath, "w") as fp:
-                    fp.writelines(lines)
+                # The format follows the extension: .txt, .jsonl, or .csv, and .gz
+                # to compress it.
+                with export.JourneyExporter(filepath) as exporter:
+                    exporter.write(rolled, rows, workbook, seed, rerolls=rerolls)
                 encounter_window["write result"].update(value="Encounters written to disk.",
                                                         visible=True,
                                                         text_color="white")
@@ -244,6 +614,12 @@ def main():
             case "exit":
                 break
 
+    if workbook_watcher is not None:
+        workbook_watcher.cancel()
+    if loader is not None:
+        loader.cancel(close=True)
+    elif workbook is not None:
+        workbook.close()
     main_window.close()
 
 
@@ -306,4 +682,14 @@ if __name__ == "__main__":
             "night": None
         }
     }
-    main()
+    # ENCOUNTER_LOG_LEVEL sets the logging level (default WARNING). If
+    # ENCOUNTER_METRICS names a file, timers and counters are collected and
+    # written to it as JSON on exit.
+    logging.basicConfig(level=os.environ.get("ENCOUNTER_LOG_LEVEL", "WARNING").upper())
+    metrics_path = os.environ.get("ENCOUNTER_METRICS")
+    metrics.enable(bool(metrics_path))
+    try:
+        main()
+    finally:
+        if metrics_path:
+            metrics.dump_json(metrics_path)
@@ -0,0 +1,109 @@
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Metrics are opt-in. While disabled, the hot paths only pay for checking this flag.
+enabled = False
+
+_counters = Counter()
+_timers = {}
+
+
+def enable(on=True):
+    """
+    This function turns the collection of timers and counters on or off.
+    :param on: bool
+    :return: None
+    """
+    global enabled
+    enabled = on
+
+
+def reset():
+    """
+    This function discards everything collected so far.
+    :return: None
+    """
+    _counters.clear()
+    _timers.clear()
+
+
+def count(name: str, n=1):
+    """
+    This function adds n to the counter called name, if metrics are enabled.
+    :param name: str
+    :param n: int
+    :return: None
+    """
+    if enabled:
+        _counters[name] += n
+
+
+def add(name: str, seconds: float, n=1):
+    """
+    This function records that n operations called name took seconds in total,
+    if metrics are enabled.
+    :param name: str
+    :param seconds: float
+    :param n: int
+    :return: None
+    """
+    if not enabled:
+        return
+    timer = _timers.get(name)
+    if timer is None:
+        _timers[name] = [n, seconds, seconds]
+    else:
+        timer[0] += n
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+
+@contextmanager
+def timer(name: str, n=1):
+    """
+    This context manager times its block and records it as n operations called
+    name (see add). Use it for coarse steps such as parsing a sheet; per-roll code
+    should check enabled and call add directly.
+    :param name: str
+    :param n: int
+    """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start, n)
+
+
+def snapshot() -> dict:
+    """
+    This function returns everything collected so far. Each timer reports its
+    number of operations, the total and longest time recorded, and the
+    operations per second.
+    :return: dict
+    """
+    timers = {}
+    for name, (n, total, longest) in _timers.items():
+        timers[name] = {"count": n,
+                        "total_seconds": total,
+                        "max_seconds": longest,
+                        "per_second": n / total if total else None}
+    return {"counters": dict(_counters), "timers": timers}
+
+
+def dump_json(filepath=None) -> str:
+    """
+    This function returns the snapshot as JSON and, if filepath is given, also
+    writes it to that file.
+    :param filepath: filepath
+    :return: str
+    """
+    text = json.dumps(snapshot(), indent=4)
+    if filepath is not None:
+        with open(filepath, "w") as fp:
+            fp.write(text)
+    return text
@@ -0,0 +1,176 @@
+import heapq
+import random
+
+import numpy as np
+
+# Weights are whole numbers: a row's full weight is its width (Max - Roll + 1)
+# times RESOLUTION, so cooldown weights can be fractions of that without rounding
+# errors building up in the tree. They are Python ints, since wide rows would
+# overflow int64.
+RESOLUTION = 1000
+
+
+class FenwickTree:
+    """
+    A Fenwick (binary indexed) tree over non-negative integer weights. Changing a
+    weight, summing a prefix, and finding the index that a point of the running
+    total falls in all take O(log n).
+    """
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.weights = [int(weight) for weight in weights]
+        # Built in O(n) by pushing each node's sum up to its parent.
+        self._tree = [0] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self._tree[parent] += self._tree[i]
+        self._top = 1 << (self.size.bit_length() - 1) if self.size else 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def total(self) -> int:
+        return self.prefix(self.size)
+
+    def prefix(self, count: int) -> int:
+        """
+        Returns the sum of the first count weights.
+        :param count: int
+        :return: int
+        """
+        total = 0
+        while count > 0:
+            total += self._tree[count]
+            count -= count & -count
+        return total
+
+    def set(self, index: int, weight: int):
+        """
+        Changes the weight at index.
+        :param index: int
+        :param weight: int
+        :return: None
+        """
+        delta = int(weight) - self.weights[index]
+        self.weights[index] = int(weight)
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def find(self, point: int) -> int:
+        """
+        Returns the index whose share of the running total contains point, i.e.
+        the smallest index with prefix(index + 1) > point. point must be less than
+        total.
+        :param point: int
+        :return: int
+        """
+        index = 0
+        step = self._top
+        while step:
+            child = index + step
+            if child <= self.size and self._tree[child] <= point:
+                index = child
+                point -= self._tree[child]
+            step >>= 1
+        return index
+
+
+class TableSampler:
+    """
+    Rolls against a CompiledTable without repeating itself. A fresh sampler rolls
+    exactly like the table, each row weighted by the width of its Roll..Max range.
+    Every row rolled is then excluded until the table runs out, or, with a
+    cooldown, weighted by cooldown_weight for the next cooldown ticks (see tick)
+    before getting its full weight back. Rows are drawn from a FenwickTree, so a
+    roll costs O(log n) however much of the table has been used, where rejection
+    sampling would slow down as the table empties.
+    When every row has been excluded, the table is refilled and starts over.
+    The total weight can be far larger than 64 bits allow, so rows are drawn with
+    a random.Random seeded from rng.
+    """
+
+    def __init__(self, table, cooldown=None, cooldown_weight=0.0, rng=None):
+        if not 0 <= cooldown_weight <= 1:
+            raise ValueError("cooldown_weight must be between 0 and 1.")
+        self.table = table
+        self.cooldown = cooldown
+        self.cooldown_weight = cooldown_weight
+        self.rng = rng or np.random.default_rng()
+        self.ticks = 0
+        self._random = random.Random(int(self.rng.integers(2 ** 63)))
+        self._full = [(high - low + 1) * RESOLUTION for low, high
+                      in zip(np.asarray(table.rolls).tolist(),
+                             np.asarray(table.maxes).tolist())]
+        self._tree = FenwickTree(self._full)
+        # Rows cooling down, as a heap of (tick they recover on, row).
+        self._cooling = []
+        self._recover_at = {}
+
+    def __repr__(self):
+        return f"TableSampler({self.table.name!r}, cooldown={self.cooldown}, " \
+               f"available={self.available})"
+
+    @property
+    def available(self) -> int:
+        """
+        The number of rows that can still be rolled at their full weight.
+        :return: int
+        """
+        return sum(1 for weight, full in zip(self._tree.weights, self._full)
+                   if weight == full)
+
+    def refill(self):
+        """
+        Gives every row its full weight back.
+        :return: None
+        """
+        for row, weight in enumerate(self._full):
+            self._tree.set(row, weight)
+        self._cooling.clear()
+        self._recover_at.clear()
+
+    def tick(self, count=1):
+        """
+        Moves time forward, e.g. by one day of a journey, giving rows whose
+        cooldown is over their full weight back.
+        :param count: int
+        :return: None
+        """
+        self.ticks += count
+        while self._cooling and self._cooling[0][0] <= self.ticks:
+            recover, row = heapq.heappop(self._cooling)
+            # Rows rolled again while cooling down have a later entry too.
+            if self._recover_at.get(row) == recover:
+                del self._recover_at[row]
+                self._tree.set(row, self._full[row])
+
+    def roll_index(self) -> int:
+        """
+        Rolls once and returns the row index, then excludes or cools down that row.
+        :return: int
+        """
+        if self._tree.total == 0:
+            self.refill()
+        row = self._tree.find(self._random.randrange(self._tree.total))
+        if self.cooldown is None:
+            self._tree.set(row, 0)
+        else:
+            self._tree.set(row, round(self._full[row] * self.cooldown_weight))
+            recover = self.ticks + self.cooldown
+            self._recover_at[row] = recover
+            heapq.heappush(self._cooling, (recover, row))
+        return row
+
+    def roll(self) -> str:
+        """
+        Rolls once and returns the formatted result. A row that refers to another
+        sheet is rolled on that sheet as usual, from rng, without the no-repeat
+        rule.
+        :return: str
+        """
+        return self.table.resolve_labels(np.array([self.roll_index()]), self.rng)[0]
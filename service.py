@@ -0,0 +1,444 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import secrets
+import time
+
+import numpy as np
+import backend
+import journey
+
+logger = logging.getLogger(__name__)
+
+# Bytes a single request line may take.
+LINE_LIMIT = 1 << 20
+# Bytes a single response line may take, enough for the largest requests allowed.
+RESPONSE_LIMIT = 16 << 20
+# Rolls a single request may ask for.
+MAX_ROLLS = 100_000
+# Journeys a single request may ask for.
+MAX_JOURNEYS = 1_000
+# Encounter slots a single journey request may ask for, i.e. journeys times days
+# times times of day, so its response is about as large as one for MAX_ROLLS rolls.
+MAX_SLOTS = 100_000
+# The counter that separates a session's table rolls from its journeys, which are
+# keyed by journey number (see journey.slot_keys).
+ROLL_STREAM = -1
+
+
+class Session:
+    """
+    One client connection. Every session rolls from its own seed: the n-th table
+    roll of the session and its n-th journey only depend on the seed and n, never on
+    other sessions or on how requests were batched.
+    """
+
+    def __init__(self, seed=None):
+        self.reseed(seed)
+
+    def reseed(self, seed=None):
+        """
+        Starts the session over from seed, or from a new random seed.
+        :param seed: int or None
+        :return: None
+        """
+        self.seed = secrets.randbits(63) if seed is None else seed
+        self.rolls = 0
+        self.journeys = 0
+
+
+class EncounterService:
+    """
+    A headless encounter service over newline-delimited JSON. Clients send one JSON
+    object per line, each with an "op" and optionally an "id" that is echoed in the
+    response, and get one JSON object per line back, in order. The operations are:
+      {"op": "tables"}: the tables that loaded, and the failures of those that did not
+      {"op": "seed", "seed": n}: restart the session from seed n (or a new one)
+      {"op": "roll", "table": name, "count": n}: roll n times on a table
+      {"op": "journey", "legs": [[name, days], ...], "chance": n,
+       "checks": [...], "count": n}: roll n journeys, as in journey.route_spec
+    Errors are answered with {"error": message}.
+    The tables are loaded and compiled once, up front, and shared by every session.
+    Roll requests that arrive together, from any number of sessions, are answered
+    with one vectorized lookup per table. Journeys are rolled on a worker thread,
+    so long ones do not hold up the other sessions.
+    """
+
+    def __init__(self, registry: backend.TableRegistry, batch_delay=0.0):
+        self.registry = registry
+        self.batch_delay = batch_delay
+        self.requests = 0
+        self.rolls = 0
+        self._pending = []
+        self._flush_handle = None
+        self._threads = set()
+
+    def load(self):
+        """
+        Loads and validates every table of the registry. Tables that fail are left
+        out of the service and reported by the "tables" operation.
+        :return: None
+        """
+        for name in self.registry.tables:
+            try:
+                self.registry.load(name)
+            except ValueError as e:
+                logger.warning("%s", e)
+
+    async def serve(self, host="127.0.0.1", port=8765, path=None) -> asyncio.AbstractServer:
+        """
+        Loads the tables without blocking the event loop and starts listening on a
+        TCP port, or on a Unix socket if path is given.
+        :param host: str
+        :param port: int, 0 for any free port
+        :param path: filepath of a Unix socket, or None
+        :return: asyncio.AbstractServer
+        """
+        await asyncio.to_thread(self.load)
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path, limit=LINE_LIMIT)
+        return await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves one client connection as its own Session. Requests are read as fast
+        as they arrive and answered in order, so a client may pipeline them.
+        :param reader: asyncio.StreamReader
+        :param writer: asyncio.StreamWriter
+        :return: None
+        """
+        session = Session()
+        answers = asyncio.Queue()
+        sender = asyncio.create_task(self._send(answers, writer))
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    answers.put_nowait(self.submit(session, line))
+        except (ConnectionError, ValueError) as e:
+            logger.debug("connection closed: %s", e)
+        finally:
+            answers.put_nowait(None)
+            await sender
+            writer.close()
+
+    async def _send(self, answers: asyncio.Queue, writer: asyncio.StreamWriter):
+        while (answer := await answers.get()) is not None:
+            response = await answer
+            try:
+                writer.write(json.dumps(response).encode() + b"\n")
+                if answers.empty():
+                    await writer.drain()
+            except ConnectionError:
+                return
+
+    def submit(self, session: Session, line: bytes) -> asyncio.Future:
+        """
+        Queues one request line for the next batch.
+        :param session: Session
+        :param line: bytes
+        :return: asyncio.Future, resolving to the response dict
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("A request must be a JSON object.")
+        except ValueError as e:
+            future.set_result({"error": f"Bad request: {e}"})
+            return future
+        self.requests += 1
+        self._pending.append((session, request, future))
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            if self.batch_delay:
+                self._flush_handle = loop.call_later(self.batch_delay, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        """
+        Answers every queued request. Table rolls are gathered across requests and
+        sessions and resolved with one call to CompiledTable.key_indices per table.
+        Journeys are numbered here, in the order their requests arrived, and rolled
+        on a worker thread.
+        """
+        pending, self._pending, self._flush_handle = self._pending, [], None
+        rolls = {}
+        for session, request, future in pending:
+            try:
+                if request.get("op") == "roll":
+                    name, keys = self._roll_keys(session, request)
+                    rolls.setdefault(name, []).append((request, future, keys))
+                elif request.get("op") == "journey":
+                    self._in_thread(future, request, self._roll_journeys,
+                                    *self._journey(session, request))
+                else:
+                    self._answer(future, request, self._run(session, request))
+            except (KeyError, TypeError, ValueError) as e:
+                self._answer(future, request, {"error": str(e)})
+        for name, waiting in rolls.items():
+            table = self.registry[name]
+            keys = np.concatenate([keys for _, _, keys in waiting])
+            labels = table.resolve_labels(table.key_indices(keys), keys=keys).tolist()
+            self.rolls += len(labels)
+            start = 0
+            for request, future, keys in waiting:
+                self._answer(future, request, {"results": labels[start:start + len(keys)]})
+                start += len(keys)
+
+    @staticmethod
+    def _answer(future: asyncio.Future, request: dict, response: dict):
+        if "id" in request:
+            response = {"id": request["id"], **response}
+        future.set_result(response)
+
+    def _in_thread(self, future: asyncio.Future, request: dict, function, *args):
+        async def run():
+            try:
+                response = await asyncio.to_thread(function, *args)
+            except (KeyError, TypeError, ValueError) as e:
+                response = {"error": str(e)}
+            self._answer(future, request, response)
+
+        # The loop only keeps weak references to its tasks.
+        task = asyncio.get_running_loop().create_task(run())
+        self._threads.add(task)
+        task.add_done_callback(self._threads.discard)
+
+    def _table(self, name):
+        if name not in self.registry:
+            raise ValueError(f"{name} is not one of the tables.")
+        failure = self.registry.failure(name)
+        if failure is not None:
+            raise ValueError(failure)
+        return self.registry[name]
+
+    @staticmethod
+    def _count(request: dict, limit: int) -> int:
+        count = request.get("count", 1)
+        if not isinstance(count, int) or not 1 <= count <= limit:
+            raise ValueError(f"count must be a whole number from 1 to {limit}.")
+        return count
+
+    def _roll_keys(self, session: Session, request: dict) -> tuple:
+        self._table(request["table"])
+        count = self._count(request, MAX_ROLLS)
+        counters = np.arange(session.rolls, session.rolls + count)
+        session.rolls += count
+        return request["table"], journey.counter_keys(session.seed, ROLL_STREAM, counters)
+
+    def _run(self, session: Session, request: dict) -> dict:
+        match request.get("op"):
+            case "tables":
+                names = [name for name in self.registry.tables
+                         if self.registry.failure(name) is None]
+                failures = [self.registry.failure(name) for name in self.registry.tables
+                            if self.registry.failure(name) is not None]
+                return {"tables": names, "failures": failures}
+            case "seed":
+                seed = request.get("seed")
+                if seed is not None and not isinstance(seed, int):
+                    raise ValueError("seed must be a whole number.")
+                session.reseed(seed)
+                return {"seed": session.seed}
+            case op:
+                raise ValueError(f"Unknown op {op}.")
+
+    def _journey(self, session: Session, request: dict) -> tuple:
+        """
+        Checks a journey request and takes the next journey numbers of the session
+        for it, returning the arguments of _roll_journeys.
+        """
+        legs = [(str(name), int(days)) for name, days in request["legs"]]
+        for name, days in legs:
+            self._table(name)
+            if days < 1:
+                raise ValueError(f"The leg through {name} must last at least one day.")
+        count = self._count(request, MAX_JOURNEYS)
+        days = sum(days for _, days in legs)
+        if count * days * len(journey.TIMES_OF_DAY) > MAX_SLOTS:
+            raise ValueError(f"{count} journeys of {days} days are too many at once; "
+                             f"ask for at most {MAX_SLOTS // len(journey.TIMES_OF_DAY)} "
+                             f"journey days in all.")
+        checks = request.get("checks", ("daytime", "evening"))
+        unknown = set(checks) - set(journey.TIMES_OF_DAY)
+        if unknown:
+            raise ValueError(f"Unknown times of day: {', '.join(sorted(unknown))}.")
+        spec = journey.route_spec(legs, int(request.get("chance", 10)),
+                                  *(time_of_day in checks
+                                    for time_of_day in journey.TIMES_OF_DAY))
+        segments = journey.segments_from_spec(spec)
+        numbers = np.arange(session.journeys, session.journeys + count)
+        session.journeys += count
+        return segments, session.seed, numbers
+
+    def _roll_journeys(self, segments: list, seed: int, numbers: np.ndarray) -> dict:
+        rows = journey.roll_seeded_rows(segments, self.registry, seed, numbers)
+        encounters = journey.label_seeded_rows(rows, segments, self.registry, seed,
+                                               numbers).tolist()
+        return {"seed": seed,
+                "journeys": [{"number": int(number), "days": days}
+                             for number, days in zip(numbers, encounters)]}
+
+
+class EncounterClient:
+    """
+    An asyncio client for EncounterService. Requests may be sent concurrently;
+    each is answered by matching the id it was sent with.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self._ids = itertools.count()
+        self._waiting = {}
+        self._receiver = asyncio.create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=8765, path=None):
+        """
+        Connects to a service on a TCP port, or on a Unix socket if path is given.
+        :param host: str
+        :param port: int
+        :param path: filepath or None
+        :return: EncounterClient
+        """
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path,
+                                                                limit=RESPONSE_LIMIT)
+        else:
+            reader, writer = await asyncio.open_connection(host, port,
+                                                           limit=RESPONSE_LIMIT)
+        return cls(reader, writer)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        await self._receiver
+
+    async def _receive(self):
+        error = ConnectionError("The service closed the connection.")
+        try:
+            while line := await self.reader.readline():
+                response = json.loads(line)
+                future = self._waiting.pop(response.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (ConnectionError, ValueError) as e:
+            # A response too long or not JSON; the ones after it cannot be matched.
+            error = ConnectionError(f"Lost the service: {e}")
+        for future in self._waiting.values():
+            if not future.done():
+                future.set_exception(error)
+        self._waiting.clear()
+
+    async def request(self, op: str, **params) -> dict:
+        """
+        Sends one request and waits for its response. Raises a ValueError if the
+        service answers with an error.
+        :param op: str
+        :param params: the other fields of the request
+        :return: dict
+        """
+        if self._receiver.done():
+            raise ConnectionError("The connection to the service was lost.")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = future
+        self.writer.write(json.dumps({"id": request_id, "op": op, **params}).encode()
+                          + b"\n")
+        await self.writer.drain()
+        response = await future
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response
+
+    async def roll(self, table: str, count=1) -> list:
+        return (await self.request("roll", table=table, count=count))["results"]
+
+    async def journey(self, legs: list, chance=10, checks=("daytime", "evening"),
+                      count=1) -> list:
+        response = await self.request("journey", legs=legs, chance=chance,
+                                      checks=list(checks), count=count)
+        return response["journeys"]
+
+
+async def bench(registry: backend.TableRegistry, sessions=50, requests=200, count=10):
+    """
+    This function starts a service on a free local port and measures how many
+    rolls per second it answers for many concurrent sessions, each pipelining its
+    requests.
+    :param registry: backend.TableRegistry
+    :param sessions: int
+    :param requests: int, per session
+    :param count: int, rolls per request
+    :return: dict
+    """
+    service = EncounterService(registry)
+    server = await service.serve(port=0)
+    port = server.sockets[0].getsockname()[1]
+    tables = (await _tables(port))["tables"]
+
+    async def session(number):
+        async with await EncounterClient.connect(port=port) as client:
+            await client.request("seed", seed=number)
+            await asyncio.gather(*(client.roll(tables[i % len(tables)], count)
+                                   for i in range(requests)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(number) for number in range(sessions)))
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    return {"sessions": sessions, "requests": service.requests, "rolls": service.rolls,
+            "seconds": elapsed, "rolls per second": service.rolls / elapsed}
+
+
+async def _tables(port):
+    async with await EncounterClient.connect(port=port) as client:
+        return await client.request("tables")
+
+
+async def main(args):
+    tables = backend.import_tables(args.tables)
+    with backend.TableRegistry(tables, args.workbook) as registry:
+        if args.bench:
+            result = await bench(registry, args.bench)
+            print(json.dumps(result, indent=4))
+            return
+        service = EncounterService(registry, args.batch_delay)
+        server = await service.serve(args.host, args.port, args.socket)
+        logger.info("serving on %s", args.socket or server.sockets[0].getsockname())
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve table rolls and journeys to many game sessions at once.")
+    parser.add_argument("--workbook", default="./samples/encounters.xlsx")
+    parser.add_argument("--tables", default="./samples/tables.json",
+                        help="json file with the table list")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", help="listen on this Unix socket instead")
+    parser.add_argument("--batch-delay", type=float, default=0.0,
+                        help="seconds to wait for more requests before answering a "
+                             "batch (default: answer as soon as the loop is idle)")
+    parser.add_argument("--bench", type=int, metavar="SESSIONS",
+                        help="measure rolls per second for this many local sessions "
+                             "instead of serving")
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import backend
+import journey
+import tablefile
+
+# Journeys simulated by each task handed to a worker. Results only depend on the
+# seed and the chunk size, never on the number of workers.
+CHUNK_SIZE = 2000
+
+_worker_tables = None
+
+
+class SimulationStats:
+    """
+    Running totals for a batch of simulated journeys over the same spec. Partial
+    results from each chunk of journeys are merged into one of these, so memory
+    stays bounded by the size of the tables and the length of the journey, not by
+    the number of journeys simulated.
+    A row that refers to another sheet (see backend.reference_of) is rolled on
+    that sheet, so the encounter that actually came up is counted too.
+    """
+
+    def __init__(self, spec: list):
+        self.spec = spec
+        self.journeys = 0
+        # Encounters rolled on each day of the journey, summed over all journeys.
+        self.by_day = np.zeros(len(spec), dtype=np.int64)
+        # Number of journey days that had 0, 1, 2, or 3 encounters.
+        self.per_day = np.zeros(len(journey.TIMES_OF_DAY) + 1, dtype=np.int64)
+        # How often each row of each table was rolled.
+        self.rows = {}
+
+    def add(self, rows: np.ndarray, tables, rng=None):
+        """
+        Adds the journeys returned by journey.roll_journey_rows, rolling the rows
+        that refer to other sheets on them from rng.
+        :param rows: np.ndarray
+        :param tables: mapping of str to CompiledTable
+        :param rng: np.random.Generator
+        :return: None
+        """
+        rng = rng or np.random.default_rng()
+        hits = rows >= 0
+        encounters = hits.sum(axis=2)
+        self.journeys += rows.shape[0]
+        self.by_day += encounters.sum(axis=0)
+        self.per_day += np.bincount(encounters.ravel(), minlength=len(self.per_day))
+        names = np.array([day["table"] for day in self.spec], dtype=object)
+        for name in dict.fromkeys(names):
+            picked = rows[hits & (names == name)[None, :, None]]
+            self._count(tables[name], np.bincount(picked, minlength=len(tables[name])),
+                        rng)
+
+    def _count(self, table, counts: np.ndarray, rng):
+        """
+        Adds how often each row of a table was rolled, then rolls the rows that
+        refer to other sheets on those sheets and counts those rolls in turn.
+        """
+        self.rows[table.name] = self.rows.get(table.name, 0) + counts
+        if not table.targets:
+            return
+        referring = table.target_index >= 0
+        referred = np.bincount(table.target_index[referring], weights=counts[referring],
+                               minlength=len(table.targets)).astype(np.int64)
+        for target in np.flatnonzero(referred).tolist():
+            subtable = table._subtable(target)
+            picked = subtable.roll_indices(int(referred[target]), rng)
+            self._count(subtable, np.bincount(picked, minlength=len(subtable)), rng)
+
+    def merge(self, other):
+        """
+        Adds the totals of another SimulationStats over the same spec.
+        :param other: SimulationStats
+        :return: None
+        """
+        self.journeys += other.journeys
+        self.by_day += other.by_day
+        self.per_day += other.per_day
+        for name, counts in other.rows.items():
+            self.rows[name] = self.rows.get(name, 0) + counts
+
+    def summary(self, tables) -> dict:
+        """
+        Returns the expected encounters per journey and per day of the journey,
+        the share of encounters of each TYPE and each ENCOUNTER, and the share of
+        journey days with 0 to 3 encounters. Rows that refer to another sheet are
+        left out of the shares, in favour of what was rolled on that sheet.
+        :param tables: mapping of str to CompiledTable
+        :return: dict
+        """
+        types = Counter()
+        encounters = Counter()
+        for name, counts in self.rows.items():
+            table = tables[name]
+            rolled = np.flatnonzero(counts)
+            rolled = rolled[table.target_index[rolled] < 0]
+            for idx, type_result, encounter in zip(rolled.tolist(), table.types[rolled],
+                                                   table.encounters[rolled]):
+                types[type_result] += int(counts[idx])
+                encounters[encounter] += int(counts[idx])
+        total = sum(types.values())
+        journeys = max(self.journeys, 1)
+        days = max(int(self.per_day.sum()), 1)
+        return {
+            "journeys": self.journeys,
+            "expected encounters per journey": total / journeys,
+            "expected encounters by day": (self.by_day / journeys).tolist(),
+            "encounters per day distribution": {
+                str(n): int(count) / days for n, count in enumerate(self.per_day)},
+            "type frequencies": {
+                key: count / total for key, count in types.most_common()},
+            "encounter frequencies": {
+                key: count / total for key, count in encounters.most_common()},
+        }
+
+
+def _init_worker(tables):
+    global _worker_tables
+    # A path is a table file, which each worker maps instead of unpickling tables.
+    _worker_tables = tablefile.open_tables(tables) if isinstance(tables, str) else tables
+
+
+def _run_chunk(spec, count, seed, tables=None):
+    tables = tables if tables is not None else _worker_tables
+    rng = np.random.default_rng(seed)
+    stats = SimulationStats(spec)
+    stats.add(journey.roll_journey_rows(spec, tables, count, rng), tables, rng)
+    return stats
+
+
+def simulate(spec: list, tables, journeys=10000, seed=None, workers=None,
+             chunk_size=CHUNK_SIZE) -> SimulationStats:
+    """
+    This function simulates journeys over a journey spec (see
+    journey.roll_journey_rows) and returns the merged statistics. The journeys are
+    split into chunks, each with its own seed spawned from seed, and the chunks
+    are spread over a pool of worker processes. Chunks are merged as they finish,
+    and only a few are in flight at a time, so any number of journeys fits in
+    bounded memory. The same seed gives the same results with any number of
+    workers.
+    Given a tablefile.TableFile, the workers map the same file rather than being
+    sent a copy of the tables, so they start at once and share one copy in memory.
+    :param spec: list of dict
+    :param tables: mapping of str to CompiledTable, e.g. a TableRegistry or TableFile
+    :param journeys: int
+    :param seed: int or None
+    :param workers: int, number of processes; defaults to the number of CPUs
+    :param chunk_size: int
+    :return: SimulationStats
+    """
+    # Only the tables on the route are loaded and sent to the workers.
+    used = {day["table"]: tables[day["table"]] for day in spec}
+    shared = tables.path if isinstance(tables, tablefile.TableFile) else used
+    counts = [chunk_size] * (journeys // chunk_size)
+    if journeys % chunk_size:
+        counts.append(journeys % chunk_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(counts))
+    workers = workers or os.cpu_count() or 1
+
+    stats = SimulationStats(spec)
+    if workers == 1:
+        for count, chunk_seed in zip(counts, seeds):
+            stats.merge(_run_chunk(spec, count, chunk_seed, used))
+        return stats
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(shared,)) as pool:
+        pending = set()
+        for count, chunk_seed in zip(counts, seeds):
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stats.merge(future.result())
+            pending.add(pool.submit(_run_chunk, spec, count, chunk_seed))
+        for future in pending:
+            stats.merge(future.result())
+    return stats
+
+
+def parse_leg(text: str) -> tuple:
+    """
+    This function reads a route leg written as "TABLE:DAYS".
+    :param text: str
+    :return: tuple of (str, int)
+    """
+    table, _, days = text.rpartition(":")
+    if not table or not days.isdigit():
+        raise argparse.ArgumentTypeError(f"{text} is not in the form TABLE:DAYS")
+    return table, int(days)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate journeys and report encounter statistics.")
+    parser.add_argument("leg", nargs="+", type=parse_leg,
+                        help='route legs in order, e.g. "Open Roads Tier0:5"')
+    parser.add_argument("--workbook", default="./samples/encounters.xlsx")
+    parser.add_argument("--table-file",
+                        help="roll against this table file (see tablefile.py) instead "
+                             "of the workbook")
+    parser.add_argument("--chance", type=int, default=10)
+    parser.add_argument("--no-daytime", dest="daytime", action="store_false")
+    parser.add_argument("--no-evening", dest="evening", action="store_false")
+    parser.add_argument("--night", action="store_true")
+    parser.add_argument("--journeys", type=int, default=10000)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    route_spec = journey.route_spec(args.leg, args.chance, args.daytime, args.evening,
+                                    args.night)
+    if args.table_file:
+        registry = tablefile.open_tables(args.table_file)
+    else:
+        registry = backend.TableRegistry(list(dict.fromkeys(table for table, _ in args.leg)),
+                                         args.workbook)
+    with registry:
+        result = simulate(route_spec, registry, args.journeys, args.seed, args.workers)
+        print(json.dumps(result.summary(registry), indent=4))
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+# Bump this whenever the stored format or the compile/validation rules change,
+# so that stale sidecars are discarded instead of being trusted.
+CACHE_VERSION = 2
+
+
+def cache_path(workbook_path) -> str:
+    """
+    This function returns the path of the cache sidecar kept next to a workbook.
+    :param workbook_path: filepath
+    :return: filepath
+    """
+    return f"{workbook_path}.cache"
+
+
+def file_digest(filepath) -> str:
+    """
+    This function returns the SHA-256 hex digest of a file's contents.
+    :param filepath: filepath
+    :return: str
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sheet_digest(columns: dict) -> str:
+    """
+    This function returns a SHA-256 hex digest of the D100, ENCOUNTER, and TYPE
+    values read from a worksheet, before D100 is parsed. It changes only when the
+    contents of that sheet change, no matter what happens to other sheets.
+    :param columns: dict of list of str
+    :return: str
+    """
+    digest = hashlib.sha256()
+    for row in zip(columns["D100"], columns["ENCOUNTER"], columns["TYPE"]):
+        digest.update(("\x1e" + "\x1f".join(row)).encode())
+    return digest.hexdigest()
+
+
+class TableCache:
+    """
+    A SQLite sidecar holding the compiled tables of one workbook. The workbook as a
+    whole is keyed by its size, modification time, and content hash, and every
+    sheet by the digest of its own contents, so a change to one sheet only
+    invalidates that sheet. Each sheet also records the workbook digest it was
+    last verified against; sheets verified against the current workbook can be
+    used without opening the workbook at all.
+    Opening the cache records the current state of the workbook.
+    """
+
+    def __init__(self, workbook_path, path=None):
+        self.workbook_path = workbook_path
+        self.path = path or cache_path(workbook_path)
+        # The owner serializes access, but may use the cache from more than one
+        # thread (see backend.TableRegistry).
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                          "(key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sheets "
+                          "(name TEXT PRIMARY KEY, digest TEXT, verified TEXT, "
+                          "rolls BLOB, maxes BLOB, encounters TEXT, types TEXT)")
+        if self._meta("version") != str(CACHE_VERSION):
+            with self.conn:
+                self.conn.execute("DELETE FROM meta")
+                self.conn.execute("DELETE FROM sheets")
+                self.conn.execute("INSERT INTO meta VALUES ('version', ?)",
+                                  (str(CACHE_VERSION),))
+        self.digest = self._refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?",
+                                (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _refresh(self) -> str:
+        """
+        Returns the digest of the workbook and records it as the current one. The
+        size and modification time are checked first; only when they differ is the
+        file hashed, so an unchanged workbook is never read.
+        :return: str
+        """
+        stat = os.stat(self.workbook_path)
+        state = f"{stat.st_size}:{stat.st_mtime_ns}"
+        digest = self._meta("file digest")
+        if digest is not None and self._meta("file state") == state:
+            return digest
+        digest = file_digest(self.workbook_path)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('file state', ?)",
+                              (state,))
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('file digest', ?)",
+                              (digest,))
+        return digest
+
+    def get(self, name: str, digest=None):
+        """
+        Returns the cached columns of a sheet as a tuple of (rolls, maxes,
+        encounters, types), or None if there is no usable entry. Without a digest,
+        the entry must have been verified against the current workbook; with one,
+        it must have been built from a sheet with that same digest, and is then
+        marked as verified against the current workbook.
+        :param name: str
+        :param digest: str
+        :return: tuple or None
+        """
+        row = self.conn.execute("SELECT digest, verified, rolls, maxes, encounters, "
+                                "types FROM sheets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        if digest is None and row[1] != self.digest:
+            return None
+        if digest is not None:
+            if row[0] != digest:
+                return None
+            if row[1] != self.digest:
+                with self.conn:
+                    self.conn.execute("UPDATE sheets SET verified = ? WHERE name = ?",
+                                      (self.digest, name))
+        return (np.frombuffer(row[2], dtype=np.int64),
+                np.frombuffer(row[3], dtype=np.int64),
+                json.loads(row[4]),
+                json.loads(row[5]))
+
+    def carry_over(self, names, digest: str):
+        """
+        Marks the sheets in names as verified against the current workbook if they
+        were verified against the workbook with the given digest, for when those
+        sheets are known not to have changed since (see watcher).
+        :param names: list of str
+        :param digest: str
+        :return: None
+        """
+        with self.conn:
+            self.conn.executemany("UPDATE sheets SET verified = ? WHERE name = ? "
+                                  "AND verified = ?",
+                                  [(self.digest, name, digest) for name in names])
+
+    def put(self, name: str, digest: str, table):
+        """
+        Stores a CompiledTable built from a sheet with the given digest, verified
+        against the current workbook.
+        :param name: str
+        :param digest: str
+        :param table: CompiledTable
+        :return: None
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO sheets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (name, digest, self.digest,
+                               table.rolls.astype(np.int64).tobytes(),
+                               table.maxes.astype(np.int64).tobytes(),
+                               json.dumps([str(x) for x in table.encounters]),
+                               json.dumps([str(x) for x in table.types])))
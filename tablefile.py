@@ -0,0 +1,300 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping
+
+import numpy as np
+import backend
+
+MAGIC = b"ENCTABLE"
+# Bump this whenever the layout below changes.
+FORMAT_VERSION = 2
+# Magic, format version, number of tables, offset and size of the directory.
+HEADER = struct.Struct("<8sIIQQ")
+# The string columns stored for each table, each as offsets into a UTF-8 blob.
+COLUMNS = ("encounters", "types", "labels")
+
+
+def table_file_path(workbook_path) -> str:
+    """
+    This function returns the path of the compiled table file kept next to a
+    workbook.
+    :param workbook_path: filepath
+    :return: filepath
+    """
+    return f"{workbook_path}.tables"
+
+
+def _pad(fp):
+    fp.write(b"\0" * (-fp.tell() % 8))
+
+
+def _write_strings(fp, strings) -> list:
+    encoded = [str(string).encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    _pad(fp)
+    offsets_at = fp.tell()
+    fp.write(offsets.tobytes())
+    blob_at = fp.tell()
+    fp.write(b"".join(encoded))
+    return [offsets_at, blob_at]
+
+
+def write_tables(path, tables: dict):
+    """
+    This function writes compiled tables to a binary file that can be memory-mapped
+    with open_tables. Each table is stored as its sorted Roll and Max columns as
+    int64 arrays, followed by its ENCOUNTER, TYPE, and formatted label strings as
+    int64 offsets into a UTF-8 blob, and the index of the table each row refers to
+    (see CompiledTable.target_index) as an int32 array; a JSON directory at the
+    end of the file gives the offset of every part and the names of the tables
+    referred to. The file is written next to path and renamed over it,
+    so a reader never sees a partly written file. Raises a ValueError if a table
+    refers to one that is not in tables, since the file could not resolve it.
+    :param path: filepath
+    :param tables: dict of CompiledTable, keyed by name
+    :return: None
+    """
+    missing = [f"{name} refers to {target}, which is not being written"
+               for name, table in tables.items() for target in table.targets
+               if target not in tables]
+    if missing:
+        raise ValueError("; ".join(missing))
+    directory = {}
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as fp:
+        fp.write(b"\0" * HEADER.size)
+        for name, table in tables.items():
+            entry = {"rows": len(table), "min_roll": table.min_roll,
+                     "max_roll": table.max_roll, "targets": table.targets}
+            for column in ("rolls", "maxes"):
+                _pad(fp)
+                entry[column] = fp.tell()
+                fp.write(np.ascontiguousarray(getattr(table, column),
+                                              dtype="<i8").tobytes())
+            for column in COLUMNS:
+                entry[column] = _write_strings(fp, getattr(table, column))
+            _pad(fp)
+            entry["target_index"] = fp.tell()
+            fp.write(np.ascontiguousarray(table.target_index, dtype="<i4").tobytes())
+            directory[name] = entry
+        data = json.dumps(directory).encode()
+        directory_at = fp.tell()
+        fp.write(data)
+        fp.seek(0)
+        fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(directory), directory_at,
+                             len(data)))
+    os.replace(temp_path, path)
+
+
+class StringColumn:
+    """
+    A column of strings read straight from a memory-mapped blob. Strings are only
+    decoded when they are indexed, by an int or an array of ints like a numpy
+    object array.
+    """
+
+    def __init__(self, buffer, offsets: np.ndarray, start: int):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.start = start
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _get(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        low, high = self.offsets[index], self.offsets[index + 1]
+        return self.buffer[self.start + low:self.start + high].decode()
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if not -len(self) <= index < len(self):
+                raise IndexError(f"index {index} is out of range")
+            return self._get(int(index))
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        result = np.empty(index.shape, dtype=object)
+        flat = result.reshape(-1)
+        for i, row in enumerate(index.reshape(-1).tolist()):
+            flat[i] = self[row]
+        return result
+
+    def __iter__(self):
+        return (self._get(index) for index in range(len(self)))
+
+
+class MappedTable(backend.CompiledTable):
+    """
+    A CompiledTable whose columns are read-only views into a memory-mapped table
+    file. Nothing is copied or parsed when it is opened, so any number of processes
+    can share one copy of the tables through the page cache. The tables that rows
+    refer to were found when the file was written.
+    """
+
+    def __init__(self, name: str, rolls, maxes, encounters, types, labels,
+                 min_roll: int, max_roll: int, targets: list, target_index):
+        self.name = name
+        self.pool = None
+        self.rolls = rolls
+        self.maxes = maxes
+        self.min_roll = min_roll
+        self.max_roll = max_roll
+        self._encounters = encounters
+        self._types = types
+        self._labels = labels
+        self.subtables = {}
+        self._targets = targets
+        self._target_index = target_index
+
+    @property
+    def encounters(self) -> StringColumn:
+        return self._encounters
+
+    @property
+    def types(self) -> StringColumn:
+        return self._types
+
+    @property
+    def labels(self) -> StringColumn:
+        return self._labels
+
+    @property
+    def label_codes(self):
+        raise TypeError("A MappedTable has no string pool.")
+
+    def lookup(self, roll: int) -> tuple:
+        idx = self.index_of(roll)
+        return self._encounters[idx], self._types[idx]
+
+    def labels_of(self, idx):
+        return self._labels[idx]
+
+    def __repr__(self):
+        return f"MappedTable({self.name!r}, rows={len(self)}, " \
+               f"range={self.min_roll}-{self.max_roll})"
+
+    def __reduce__(self):
+        # Columns are views into a memory map, so copy them out when pickled, along
+        # with the tables rows refer to.
+        return (backend.CompiledTable,
+                (np.array(self.rolls), np.array(self.maxes), list(self.encounters),
+                 list(self.types), self.name),
+                {"subtables": dict(self.subtables)})
+
+
+class TableFile(Mapping):
+    """
+    A memory-mapped table file written by write_tables, read as a mapping of table
+    name to MappedTable. Opening it reads only the header and directory. A table is
+    linked to the tables it refers to (see backend.reference_of) when it is first
+    taken; write_tables has already checked that they are in the file, and
+    export_workbook that they form no cycle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, directory_at, size = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} table file.")
+        self._directory = json.loads(self._map[directory_at:directory_at + size])
+        self._tables = {}
+
+    def __getitem__(self, name: str) -> MappedTable:
+        table = self._tables.get(name)
+        if table is None:
+            entry = self._directory[name]
+            rows = entry["rows"]
+            columns = {column: self._strings(*entry[column], rows) for column in COLUMNS}
+            table = MappedTable(name, self._array(entry["rolls"], rows),
+                                self._array(entry["maxes"], rows), **columns,
+                                min_roll=entry["min_roll"], max_roll=entry["max_roll"],
+                                targets=entry["targets"],
+                                target_index=self._array(entry["target_index"], rows,
+                                                         "<i4"))
+            self._tables[name] = table
+            for target in table.targets:
+                table.subtables[target] = self[target]
+        return table
+
+    def __iter__(self):
+        return iter(self._directory)
+
+    def __len__(self):
+        return len(self._directory)
+
+    def __repr__(self):
+        return f"TableFile({self.path!r}, tables={len(self)})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Unmaps the file. Tables taken from it must not be used afterwards.
+        :return: None
+        """
+        self._tables.clear()
+        try:
+            self._map.close()
+        except BufferError:
+            # numpy views of the map are still alive; it is unmapped when they go.
+            pass
+
+    def _array(self, offset: int, count: int, dtype="<i8") -> np.ndarray:
+        return np.frombuffer(self._map, dtype=dtype, count=count, offset=offset)
+
+    def _strings(self, offsets_at: int, blob_at: int, count: int) -> StringColumn:
+        return StringColumn(self._map, self._array(offsets_at, count + 1), blob_at)
+
+
+def open_tables(path) -> TableFile:
+    """
+    This function memory-maps a table file written by write_tables.
+    :param path: filepath
+    :return: TableFile
+    """
+    return TableFile(path)
+
+
+def export_workbook(tables: list, filepath, path=None) -> str:
+    """
+    This function loads and validates every table of a workbook (see
+    backend.TableRegistry) and writes them to a table file, by default next to the
+    workbook. Raises a ValueError listing the tables that failed validation.
+    :param tables: list of str
+    :param filepath: filepath
+    :param path: filepath or None
+    :return: filepath: where the table file was written
+    """
+    path = path or table_file_path(filepath)
+    with backend.TableRegistry(tables, filepath) as registry:
+        bad_tables = registry.validate_all()
+        if bad_tables:
+            raise ValueError("The following tables are improperly formatted: "
+                             + "; ".join(bad_tables))
+        write_tables(path, dict(registry.items()))
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compile a workbook's tables into a memory-mappable table file.")
+    parser.add_argument("--workbook", default="./samples/encounters.xlsx")
+    parser.add_argument("--tables", default="./samples/tables.json",
+                        help="json file with the table list")
+    parser.add_argument("--output", help="table file to write (default: next to the "
+                                         "workbook)")
+    args = parser.parse_args()
+    print(f"Wrote {export_workbook(backend.import_tables(args.tables), args.workbook, args.output)}")
@@ -0,0 +1,634 @@
+import asyncio
+
+import numpy as np
+import pytest
+import backend
+import benchmark
+import export
+import journey
+import metrics
+import sampler
+import service
+import tablecache
+
+
+def make_table(rows, name="Table"):
+    """
+    Builds a CompiledTable from (D100, ENCOUNTER, TYPE) tuples.
+    """
+    rolls, maxes = backend.parse_d100_fields([row[0] for row in rows])
+    return backend.CompiledTable(rolls, maxes, [row[1] for row in rows],
+                                 [row[2] for row in rows], name=name)
+
+
+def segments_for(*legs, chance=100):
+    spec = journey.route_spec(list(legs), chance, True, True, True)
+    return journey.segments_from_spec(spec)
+
+
+@pytest.fixture
+def workbook(tmp_path):
+    filepath = tmp_path / "encounters.xlsx"
+    sheets = {
+        "Roads": [("1-50", "Bandit", "Mnst"), ("51-100", "Wolf", "Mnst")],
+        "Towns": [("1", "Thug", "Mnst"), ("2–3", "Social", "pg 103"),
+                  ("4-100", "Ceremony", "Expl")],
+        "Fields": [("1-100", "Hail Storm", "Expl")],
+    }
+    benchmark.make_workbook(filepath, sheets)
+    return str(filepath), sheets
+
+
+# parse_d100_fields
+
+def test_parse_single_and_ranges():
+    rolls, maxes = backend.parse_d100_fields(["1", "2-3", "4–5", " 6 - 9 ", "10\xa0-\xa011"])
+    assert rolls.tolist() == [1, 2, 4, 6, 10]
+    assert maxes.tolist() == [1, 3, 5, 9, 11]
+
+
+def test_parse_double_zero_is_one_hundred():
+    rolls, maxes = backend.parse_d100_fields(["96-00", "00"])
+    assert rolls.tolist() == [96, 100]
+    assert maxes.tolist() == [100, 100]
+
+
+def test_parse_longest_numbers():
+    top = "9" * backend.D100_MAX_DIGITS
+    rolls, maxes = backend.parse_d100_fields([f"1-{top}"])
+    assert maxes.tolist() == [int(top)]
+    with pytest.raises(ValueError):
+        backend.parse_d100_fields([f"1-{top}9"])
+
+
+def test_parse_empty_column():
+    rolls, maxes = backend.parse_d100_fields([])
+    assert len(rolls) == len(maxes) == 0
+
+
+@pytest.mark.parametrize("field", ["", "-", "1-", "-2", "1-2-3", "1 2", "a", "1.5",
+                                   "1—2", None])
+def test_parse_rejects(field):
+    with pytest.raises(ValueError, match="rows 3 "):
+        backend.parse_d100_fields(["1", field, "3"])
+
+
+def test_parse_reports_given_rows():
+    with pytest.raises(ValueError, match="rows 7, 9 "):
+        backend.parse_d100_fields(["1", "x", "3", "y"], [2, 7, 8, 9])
+
+
+def test_parse_counts_rows_past_the_first_few():
+    with pytest.raises(ValueError) as error:
+        backend.parse_d100_fields(["x"] * 100_000)
+    listed = ", ".join(str(row) for row in range(2, 2 + backend.REPORTED_ROWS))
+    assert str(error.value) == (
+        f"D100 fields in rows {listed} and {100_000 - backend.REPORTED_ROWS} more are "
+        f"not a single integer or range.")
+
+
+# find_overlaps_and_gaps
+
+def test_contiguous_rows_have_no_overlaps_or_gaps():
+    assert backend.find_overlaps_and_gaps([1, 11, 51], [10, 50, 100]) == []
+
+
+def test_overlaps_and_gaps():
+    rolls = [1, 8, 21, 23, 40]
+    maxes = [10, 20, 21, 30, 50]
+    assert backend.find_overlaps_and_gaps(rolls, maxes) == [
+        "overlap 8-10", "gap 22", "gap 31-39"]
+
+
+def test_validate_reports_ranges(tmp_path):
+    filepath = tmp_path / "bad.xlsx"
+    benchmark.make_workbook(filepath, {"Bad": [("1-10", "a", "b"), ("10-20", "c", "d"),
+                                               ("25-30", "e", "f")]})
+    assert backend.validate_workbook(["Bad"], filepath) == [
+        "Bad Prop 7/8 Failed at ranges: overlap 10, gap 21-24"]
+
+
+def test_validate_sparse_span_quickly():
+    assert benchmark.bench_validate_sparse(span=10 ** 12, budget=5.0) < 5.0
+
+
+# FenwickTree and TableSampler
+
+def test_fenwick_find_matches_cumsum():
+    rng = np.random.default_rng(1)
+    weights = rng.integers(0, 5, 37)
+    tree = sampler.FenwickTree(weights)
+    for index, weight in [(0, 3), (5, 0), (36, 9), (17, 1)]:
+        tree.set(index, weight)
+        weights[index] = weight
+    assert tree.total == weights.sum()
+    totals = np.cumsum(weights)
+    for point in range(tree.total):
+        assert tree.find(point) == np.searchsorted(totals, point, side="right")
+    assert tree.prefix(10) == weights[:10].sum()
+
+
+def test_sampler_never_repeats_until_refill():
+    table = make_table([(str(i), f"E{i}", "T") for i in range(1, 11)])
+    roller = sampler.TableSampler(table, rng=np.random.default_rng(0))
+    first = [roller.roll_index() for _ in range(10)]
+    assert sorted(first) == list(range(10))
+    assert roller.available == 0
+    roller.roll_index()
+    assert roller.available == 9
+
+
+def test_sampler_cooldown():
+    table = make_table([("1", "A", "T"), ("2", "B", "T")])
+    roller = sampler.TableSampler(table, cooldown=2, rng=np.random.default_rng(0))
+    row = roller.roll_index()
+    roller.tick()
+    assert roller.roll_index() != row
+    roller.tick()
+    assert roller.available >= 1
+
+
+def test_sampler_is_reproducible():
+    table = make_table([(f"{i}-{i}", f"E{i}", "T") for i in range(1, 51)])
+    samplers = [sampler.TableSampler(table, rng=np.random.default_rng(5)) for _ in range(2)]
+    first, second = ([roller.roll_index() for _ in range(60)] for roller in samplers)
+    assert first == second
+
+
+def test_sampler_handles_wide_spans():
+    table = make_table([("1-10000000000000000", "Narrow", "T"),
+                        ("10000000000000001-100000000000000000", "Wide", "T")])
+    roller = sampler.TableSampler(table, rng=np.random.default_rng(3))
+    assert sorted(roller.roll_index() for _ in range(2)) == [0, 1]
+    assert roller.available == 0
+
+
+# Seeded journeys
+
+def test_seeded_journeys_do_not_depend_on_batches():
+    tables = {"Roads": make_table([("1-50", "Bandit", "Mnst"), ("51-100", "Wolf", "Mnst")],
+                                  "Roads")}
+    segments = segments_for(("Roads", 20), chance=40)
+    together = journey.roll_seeded_rows(segments, tables, 42, 6)
+    apart = journey.roll_seeded_rows(segments, tables, 42, np.array([4, 5]))
+    assert (together[4:] == apart).all()
+
+
+def test_reroll_matches_regenerating():
+    tables = {"Roads": make_table([(str(i), f"E{i}", "T") for i in range(1, 101)],
+                                  "Roads")}
+    segments = segments_for(("Roads", 10))
+    rows = journey.roll_seeded_rows(segments, tables, 7)[0]
+    before = rows.copy()
+    rerolls = np.zeros_like(rows)
+    journey.reroll(rows, rerolls, segments, tables, 7, 3)
+    journey.reroll(rows, rerolls, segments, tables, 7, 3, slot=1)
+    assert rerolls[3].tolist() == [1, 2, 1]
+    assert (rows[:3] == before[:3]).all() and (rows[4:] == before[4:]).all()
+    again = journey.roll_seeded_rows(segments, tables, 7, rerolls=rerolls)[0]
+    assert (again == rows).all()
+
+
+@pytest.mark.parametrize("day", [-1, 10])
+def test_reroll_rejects_days_outside_the_journey(day):
+    tables = {"Roads": make_table([("1-100", "Bandit", "Mnst")], "Roads")}
+    segments = segments_for(("Roads", 10))
+    rows = journey.roll_seeded_rows(segments, tables, 7)[0]
+    before = rows.copy()
+    rerolls = np.zeros_like(rows)
+    with pytest.raises(ValueError):
+        journey.reroll(rows, rerolls, segments, tables, 7, day)
+    assert (rows == before).all() and not rerolls.any()
+
+
+def test_save_page_keeps_segments_when_an_edit_does_not_fit():
+    pytest.importorskip("PySimpleGUI")
+    import main
+
+    segments = [journey.make_segment(day, day + 6, "Roads", 10)
+                for day in range(0, 63, 7)]
+    before = [dict(segment) for segment in segments]
+    values = {f"terrain choice{row}": "Roads" for row in range(2)}
+    values.update({f"chance{row}": "10" for row in range(2)})
+    values.update({f"{time_of_day}{row}": True for row in range(2)
+                   for time_of_day in journey.TIMES_OF_DAY})
+    values.update({"last day0": "70", "last day1": "62"})
+    with pytest.raises(ValueError, match="Segment 9 ends on day 62"):
+        main.save_page(values, segments, 1)
+    assert segments == before
+    values["last day0"] = "58"
+    main.save_page(values, segments, 1)
+    assert [(segment["start"], segment["end"]) for segment in segments[7:]] == \
+        [(49, 58), (59, 62)]
+
+
+# Export
+
+def export_tables():
+    return {"Roads": make_table([("1-50", "Bandit", "Mnst"), ("51-100", "Wolf", "Mnst")],
+                                "Roads"),
+            "Towns": make_table([("1-30", "Thug", "Mnst"), ("31-100", "Social", "pg 103")],
+                                "Towns")}
+
+
+@pytest.mark.parametrize("suffix", [".jsonl", ".csv", ".txt", ".csv.gz", ".jsonl.gz"])
+def test_export_does_not_depend_on_batch_size(tmp_path, suffix):
+    tables = export_tables()
+    segments = segments_for(("Roads", 4), ("Towns", 3), chance=50)
+    path = tmp_path / f"journeys{suffix}"
+    written = []
+    for batch_size in (1, 3, 1000):
+        assert export.export_journeys(path, segments, tables, 7, 11,
+                                      batch_size=batch_size) == 7
+        written.append(path.read_bytes())
+    assert written[0] == written[1] == written[2]
+
+
+def test_export_writes_one_record_per_day(tmp_path):
+    import csv
+    import gzip
+    import json
+
+    tables = export_tables()
+    segments = segments_for(("Roads", 2), ("Towns", 1), chance=50)
+    numbers = np.arange(3)
+    rows = journey.roll_seeded_rows(segments, tables, 5, numbers)
+    rolled = journey.label_seeded_rows(rows, segments, tables, 5, numbers)
+    expected = [{"journey": number, "seed": 5, "day": day, "table": table,
+                 "chance": 50, **dict(zip(journey.TIMES_OF_DAY, rolled[number, day]))}
+                for number in range(3)
+                for day, table in enumerate(["Roads", "Roads", "Towns"])]
+    export.export_journeys(tmp_path / "out.jsonl", segments, tables, 3, 5)
+    with open(tmp_path / "out.jsonl") as fp:
+        assert [json.loads(line) for line in fp] == expected
+    export.export_journeys(tmp_path / "out.csv.gz", segments, tables, 3, 5)
+    with gzip.open(tmp_path / "out.csv.gz", "rt", newline="") as fp:
+        records = list(csv.DictReader(fp))
+    assert list(records[0]) == list(export.FIELDS)
+    assert records == [{key: "" if value is None else str(value)
+                        for key, value in record.items()} for record in expected]
+
+
+# TableCache
+
+def load_counting(filepath, names):
+    """
+    Loads the tables with load_workbook and returns them with the metrics it
+    recorded.
+    """
+    metrics.reset()
+    metrics.enable()
+    try:
+        tables, failures = backend.load_workbook(names, filepath)
+        collected = metrics.snapshot()
+    finally:
+        metrics.enable(False)
+        metrics.reset()
+    assert failures is None
+    return tables, collected
+
+
+def test_cache_only_reloads_edited_sheets(workbook):
+    filepath, sheets = workbook
+    names = list(sheets)
+    _, cold = load_counting(filepath, names)
+    assert cold["counters"] == {"cache misses": 3}
+    tables, warm = load_counting(filepath, names)
+    assert warm["counters"] == {"cache hits": 3}
+    assert "open workbook" not in warm["timers"]
+    assert tables["Towns"].labels.tolist() == [
+        "Thug (Mnst)", "Social (pg 103)", "Ceremony (Expl)"]
+    sheets["Fields"] = [("1-100", "Drought", "Expl")]
+    benchmark.make_workbook(filepath, sheets)
+    tables, edited = load_counting(filepath, names)
+    assert edited["counters"] == {"cache hits": 2, "cache misses": 1}
+    assert tables["Fields"].labels.tolist() == ["Drought (Expl)"]
+
+
+def test_cache_version_bump_clears_the_cache(workbook, monkeypatch):
+    filepath, sheets = workbook
+    backend.load_workbook(list(sheets), filepath)
+    with tablecache.TableCache(filepath) as cache:
+        assert cache.get("Roads") is not None
+    monkeypatch.setattr(tablecache, "CACHE_VERSION", tablecache.CACHE_VERSION + 1)
+    with tablecache.TableCache(filepath) as cache:
+        assert cache.get("Roads") is None
+        assert cache.conn.execute("SELECT COUNT(*) FROM sheets").fetchone() == (0,)
+
+
+# StringPool
+
+def test_string_pool_shares_strings_between_tables(workbook):
+    pool = backend.StringPool()
+    first = backend.CompiledTable([1, 51], [50, 100], ["Bandit", "Wolf"], ["Mnst", "Mnst"],
+                                  name="First", pool=pool)
+    second = backend.CompiledTable([1, 51], [50, 100], ["Wolf", "Ceremony"],
+                                   ["Mnst", "Expl"], name="Second", pool=pool)
+    assert len(pool) == 5
+    assert first.encounter_codes[1] == second.encounter_codes[0]
+    assert (first.type_codes == second.type_codes[0]).all()
+    assert second.encounters.tolist() == ["Wolf", "Ceremony"]
+    filepath, sheets = workbook
+    with backend.TableRegistry(list(sheets), filepath) as registry:
+        assert registry["Roads"].pool is registry["Towns"].pool
+        assert registry["Roads"].type_codes[0] == registry["Towns"].type_codes[0]
+
+
+def test_string_pool_codes_survive_pickling():
+    import pickle
+
+    pool = backend.StringPool()
+    tables = [backend.CompiledTable([1], [100], [encounter], ["Mnst"], name=encounter,
+                                    pool=pool) for encounter in ["Bandit", "Wolf"]]
+    first, second = pickle.loads(pickle.dumps(tables))
+    assert first.pool is second.pool and len(first.pool) == 3
+    assert first.encounter_codes.tolist() == tables[0].encounter_codes.tolist()
+    assert [first.labels.tolist(), second.labels.tolist()] == [
+        ["Bandit (Mnst)"], ["Wolf (Mnst)"]]
+    size = len(first.pool)
+    assert first.pool.intern(["Wolf", "Hail Storm"]).tolist() == [
+        second.encounter_codes[0], size]
+
+
+# TableRegistry
+
+def test_registry_contains_does_not_load(workbook):
+    filepath, sheets = workbook
+    with backend.TableRegistry(["Roads", "Missing"], filepath) as registry:
+        assert "Missing" in registry
+        assert "Towns" not in registry
+        assert not registry.is_loaded("Missing")
+        assert registry.failure("Missing") is None
+
+
+def test_registry_reports_worksheet_rows(tmp_path):
+    import openpyxl
+
+    filepath = tmp_path / "blank.xlsx"
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Gappy"
+    ws.append(["D100", "ENCOUNTER", "TYPE"])
+    ws.append(["1", "a", "b"])
+    ws.append(["x", "c", "d"])
+    ws.move_range("A3:C3", rows=2)
+    wb.save(filepath)
+    assert backend.validate_workbook(["Gappy"], filepath) == [
+        "Gappy Property 3 and/or 4 Failed: D100 fields in rows 5 are not a single "
+        "integer or range."]
+
+
+def test_registry_refresh_only_reloads_changed_sheets(workbook):
+    filepath, sheets = workbook
+    names = list(sheets)
+    with backend.TableRegistry(names, filepath) as registry:
+        assert registry.validate_all() is None
+        sheets["Fields"] = [("1-100", "Drought", "Expl")]
+        benchmark.make_workbook(filepath, sheets)
+        with registry.refresh(names, {"Fields"}) as refreshed:
+            assert refreshed["Roads"] is registry["Roads"]
+            assert refreshed["Towns"] is registry["Towns"]
+            assert refreshed["Fields"] is not registry["Fields"]
+            assert refreshed["Fields"].labels.tolist() == ["Drought (Expl)"]
+            assert registry["Fields"].labels.tolist() == ["Hail Storm (Expl)"]
+
+
+def test_registry_refresh_reports_new_failures(workbook):
+    filepath, sheets = workbook
+    names = list(sheets)
+    with backend.TableRegistry(names, filepath) as registry:
+        registry.validate_all()
+        sheets["Towns"] = [("1-10", "Thug", "Mnst"), ("5-100", "Social", "pg 103")]
+        benchmark.make_workbook(filepath, sheets)
+        with registry.refresh(names + ["Extra"], {"Towns", "Extra"}) as refreshed:
+            assert refreshed.failure("Towns") == \
+                "Towns Prop 7/8 Failed at ranges: overlap 5-10"
+            assert refreshed.failure("Extra") == "Extra was not found in the workbook"
+            assert refreshed.is_loaded("Roads")
+
+
+def test_fingerprint_reports_only_the_edited_sheet(workbook):
+    import watcher
+
+    filepath, sheets = workbook
+    before = watcher.WorkbookFingerprint(filepath)
+    assert set(before.sheets) == set(sheets)
+    # The new strings move the shared strings of the other sheets to new indices.
+    sheets["Roads"] = [("1-50", "Bandit", "Mnst"), ("51-90", "Direwolf", "Beast"),
+                       ("91-100", "Wolf", "Mnst")]
+    benchmark.make_workbook(filepath, sheets)
+    after = watcher.WorkbookFingerprint(filepath, before)
+    assert after.changed(before) == {"Roads"}
+    assert watcher.WorkbookFingerprint(filepath).sheets == after.sheets
+    del sheets["Fields"]
+    benchmark.make_workbook(filepath, sheets)
+    assert watcher.WorkbookFingerprint(filepath, after).changed(after) == {"Fields"}
+
+
+def test_background_loader_skips_unlisted_first_tables(workbook):
+    filepath, sheets = workbook
+    events = []
+    with backend.TableRegistry(["Roads", "Towns"], filepath) as registry:
+        loader = backend.BackgroundLoader(registry, lambda *event: events.append(event),
+                                          first=["Fields", "Towns"]).start()
+        loader.join(10)
+        assert not registry.is_loaded("Fields")
+    assert [event[0] for event in events] == ["Towns", "Roads", None]
+    assert all(done <= total for _, done, total, _ in events)
+
+
+# Sub-table references
+
+@pytest.fixture
+def referring_workbook(tmp_path):
+    filepath = tmp_path / "references.xlsx"
+    sheets = {
+        "Top": [("1-50", "Wolf", "Mnst"), ("51-100", "@Mid", "Ref")],
+        "Mid": [("1-50", "Bandit", "NPC"), ("51-100", "@ Leaf ", "Ref")],
+        "Leaf": [("1-100", "Ruin", "Expl")],
+        "Loop": [("1-100", "@Back", "Ref")],
+        "Back": [("1-100", "@Loop", "Ref")],
+        "Lost": [("1-100", "@Nowhere", "Ref")],
+    }
+    benchmark.make_workbook(filepath, sheets)
+    return str(filepath), list(sheets)
+
+
+def test_references_resolve_through_subtables(referring_workbook):
+    filepath, names = referring_workbook
+    with backend.TableRegistry(names, filepath) as registry:
+        top = registry["Top"]
+        assert top.targets == ["Mid"]
+        assert top.subtables["Mid"].subtables["Leaf"] is registry["Leaf"]
+        rolled = set(top.roll_many(500, np.random.default_rng(0)))
+        assert rolled == {"Wolf (Mnst)", "Bandit (NPC)", "Ruin (Expl)"}
+
+
+def test_broken_references_fail_validation(referring_workbook):
+    filepath, names = referring_workbook
+    with backend.TableRegistry(names, filepath) as registry:
+        assert sorted(registry.validate_all()) == [
+            "Back Reference cycle: Loop -> Back -> Loop",
+            "Loop refers to Back, which failed validation",
+            "Lost refers to Nowhere, which is not in the table list"]
+
+
+def test_table_file_keeps_references(referring_workbook, tmp_path):
+    import tablefile
+
+    filepath, names = referring_workbook
+    segments = segments_for(("Top", 30))
+    with backend.TableRegistry(names[:3], filepath) as registry:
+        path = tablefile.export_workbook(names[:3], filepath, tmp_path / "tables")
+        rows = journey.roll_seeded_rows(segments, registry, 11, 3)
+        expected = journey.label_seeded_rows(rows, segments, registry, 11, 3)
+        with tablefile.open_tables(path) as tables:
+            assert tables["Top"].targets == ["Mid"]
+            assert tables["Top"].target_index.tolist() == [-1, 0]
+            labels = journey.label_seeded_rows(rows, segments, tables, 11, 3)
+            assert (labels == expected).all()
+
+
+def test_table_file_needs_the_tables_referred_to(referring_workbook, tmp_path):
+    import tablefile
+
+    filepath, names = referring_workbook
+    path = tmp_path / "tables"
+    with backend.TableRegistry(names[:3], filepath) as registry:
+        with pytest.raises(ValueError, match="Mid refers to Leaf, which is not being"):
+            tablefile.write_tables(path, {name: registry[name] for name in names[:2]})
+    assert not path.exists()
+
+
+def test_pickled_mapped_tables_keep_references(referring_workbook, tmp_path):
+    import pickle
+    import tablefile
+
+    filepath, names = referring_workbook
+    path = tablefile.export_workbook(names[:3], filepath, tmp_path / "tables")
+    with tablefile.open_tables(path) as tables:
+        top = pickle.loads(pickle.dumps(tables["Top"]))
+    assert type(top) is backend.CompiledTable
+    assert set(top.roll_many(500, np.random.default_rng(0))) == {
+        "Wolf (Mnst)", "Bandit (NPC)", "Ruin (Expl)"}
+
+
+def test_samplers_roll_sub_tables_from_their_own_rng(referring_workbook):
+    filepath, names = referring_workbook
+    with backend.TableRegistry(names, filepath) as registry:
+        samplers = [sampler.TableSampler(registry["Top"], cooldown=0,
+                                         rng=np.random.default_rng(8)) for _ in range(2)]
+        first, second = ([roller.roll() for _ in range(50)] for roller in samplers)
+    assert first == second
+
+
+def test_simulation_counts_what_references_rolled(referring_workbook):
+    import simulation
+
+    filepath, names = referring_workbook
+    spec = journey.route_spec([("Top", 10)], 100, True, True, True)
+    with backend.TableRegistry(names[:3], filepath) as registry:
+        stats = simulation.simulate(spec, registry, 2000, seed=4, workers=1)
+        summary = stats.summary(registry)
+    assert set(stats.rows) == {"Top", "Mid", "Leaf"}
+    assert stats.rows["Leaf"].sum() == stats.rows["Mid"][1]
+    frequencies = summary["encounter frequencies"]
+    assert set(frequencies) == {"Wolf", "Bandit", "Ruin"}
+    assert frequencies["Wolf"] == pytest.approx(0.5, abs=0.01)
+    assert frequencies["Ruin"] == pytest.approx(0.25, abs=0.01)
+    assert set(summary["type frequencies"]) == {"Mnst", "NPC", "Expl"}
+
+
+# EncounterService
+
+def run_service(workbook, client_code, batch_delay=0.0):
+    """
+    Serves the workbook's tables on a free local port for as long as
+    client_code(port) runs, and returns what it returned.
+    """
+    filepath, sheets = workbook
+
+    async def main():
+        with backend.TableRegistry(list(sheets), filepath) as registry:
+            server = await service.EncounterService(registry, batch_delay).serve(port=0)
+            try:
+                return await client_code(server.sockets[0].getsockname()[1])
+            finally:
+                server.close()
+                await server.wait_closed()
+
+    return asyncio.run(main())
+
+
+def test_service_sessions_roll_from_their_own_seed(workbook):
+    async def session(port, seed):
+        async with await service.EncounterClient.connect(port=port) as client:
+            await client.request("seed", seed=seed)
+            return (await client.roll("Roads", 20),
+                    await client.journey([["Towns", 3]], chance=50, count=2))
+
+    async def sessions(port):
+        return await asyncio.gather(session(port, 5), session(port, 5), session(port, 6))
+
+    first, second, other = run_service(workbook, sessions)
+    assert first == second
+    assert first[0] != other[0]
+    assert [journey["number"] for journey in first[1]] == [0, 1]
+
+
+def test_service_batches_do_not_change_results(workbook):
+    async def pipelined(port, seed):
+        async with await service.EncounterClient.connect(port=port) as client:
+            await client.request("seed", seed=seed)
+            return await asyncio.gather(*(client.roll(table, 3)
+                                          for table in ["Roads", "Towns"] * 4))
+
+    async def together(port):
+        return await asyncio.gather(pipelined(port, 1), pipelined(port, 2))
+
+    async def apart(port):
+        return [await pipelined(port, 1), await pipelined(port, 2)]
+
+    assert run_service(workbook, together, batch_delay=0.05) == \
+        run_service(workbook, apart)
+
+
+def test_service_answers_errors(workbook):
+    async def errors(port):
+        async with await service.EncounterClient.connect(port=port) as client:
+            for op, params, message in [
+                    ("roll", {"table": "Nowhere"}, "Nowhere is not one of the tables."),
+                    ("roll", {"table": "Roads", "count": 0}, "count must be"),
+                    ("journey", {"legs": [["Roads", 3_000_000]]}, "too many at once"),
+                    ("dance", {}, "Unknown op dance.")]:
+                with pytest.raises(ValueError, match=message):
+                    await client.request(op, **params)
+            assert len(await client.roll("Roads")) == 1
+        reader, writer = await asyncio.open_connection(port=port)
+        writer.write(b"not json\n[1]\n")
+        answers = [await reader.readline(), await reader.readline()]
+        writer.close()
+        return answers
+
+    bad_json, not_object = run_service(workbook, errors)
+    assert bad_json.startswith(b'{"error": "Bad request: ')
+    assert b"must be a JSON object" in not_object
+
+
+def test_client_fails_waiting_requests_on_bad_responses():
+    async def garbled(reader, writer):
+        await reader.readline()
+        writer.write(b"not json\n")
+        await writer.drain()
+
+    async def main():
+        server = await asyncio.start_server(garbled, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with await service.EncounterClient.connect(port=port) as client:
+            with pytest.raises(ConnectionError, match="Lost the service"):
+                await asyncio.wait_for(client.roll("Roads"), 5)
+            with pytest.raises(ConnectionError):
+                await client.roll("Roads")
+        server.close()
+
+    asyncio.run(main())
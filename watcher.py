@@ -0,0 +1,292 @@
+import argparse
+import hashlib
+import logging
+import os
+import posixpath
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+
+import backend
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of the watched files.
+POLL_INTERVAL = 1.0
+# A cell holding an index into the shared strings, e.g. <c r="B2" t="s"><v>12</v></c>,
+# matched from its type so the search only stops at such cells.
+SHARED_TYPE = b't="s"'
+SHARED_CELL = re.compile(re.escape(SHARED_TYPE) + rb'[^>]*>\s*<(?:\w+:)?v>(\d+)<')
+# One entry of the shared strings part, kept as raw XML.
+SHARED_STRING = re.compile(rb"<(?:\w+:)?si\s*/>|<(?:\w+:)?si\b.*?</(?:\w+:)?si>", re.S)
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _relationships(zf: zipfile.ZipFile, part: str) -> dict:
+    """
+    Returns the relationships of a part of the archive, "" for the package itself,
+    as a dict of id to (type, path of the target part).
+    """
+    folder, name = posixpath.split(part)
+    try:
+        data = zf.read(posixpath.join(folder, "_rels", f"{name}.rels"))
+    except KeyError:
+        return {}
+    relationships = {}
+    for element in ET.fromstring(data):
+        target = element.get("Target", "")
+        if element.get("TargetMode") == "External":
+            continue
+        if target.startswith("/"):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(folder, target))
+        relationships[element.get("Id")] = (element.get("Type", ""), target)
+    return relationships
+
+
+def _stamp(zf: zipfile.ZipFile, part):
+    if part is None:
+        return None
+    info = zf.getinfo(part)
+    return info.CRC, info.file_size
+
+
+def sheet_fingerprint(data: bytes, strings: list) -> str:
+    """
+    This function returns a SHA-256 hex digest of a worksheet's XML and of the
+    shared strings its cells use, in the order they use them.
+    :param data: bytes, the worksheet part
+    :param strings: list of bytes, the raw entries of the shared strings part
+    :return: str
+    """
+    digest = hashlib.sha256(data)
+    if not strings:
+        return digest.hexdigest()
+    indices = SHARED_CELL.findall(data)
+    if len(indices) != data.count(SHARED_TYPE):
+        # A shared string cell was written in a way SHARED_CELL does not know, so
+        # count on every shared string instead.
+        indices = range(len(strings))
+    for index in indices:
+        index = int(index)
+        digest.update(b"\x1e" + (strings[index] if index < len(strings) else b""))
+    return digest.hexdigest()
+
+
+class WorkbookFingerprint:
+    """
+    The fingerprint of every sheet of an xlsx workbook, keyed by sheet name in
+    sheets (see sheet_fingerprint). It is read straight from the zip archive
+    without parsing a single cell, and changes exactly when what openpyxl reads
+    from that sheet may have changed, whatever happens to the other sheets.
+    Given the fingerprint of an earlier version of the workbook, sheets whose part
+    has the same CRC in the zip directory are not even decompressed, as long as
+    the shared strings did not change either.
+    """
+
+    def __init__(self, filepath, previous=None):
+        self.filepath = filepath
+        self.sheets = {}
+        self._parts = {}
+        with zipfile.ZipFile(filepath) as zf:
+            workbook = next(target for kind, target in _relationships(zf, "").values()
+                            if kind.endswith("/officeDocument"))
+            relationships = _relationships(zf, workbook)
+            strings_part = next((target for kind, target in relationships.values()
+                                 if kind.endswith("/sharedStrings")), None)
+            self._strings = _stamp(zf, strings_part)
+            reuse = previous is not None and previous._strings == self._strings
+            strings = None
+            for sheet in ET.fromstring(zf.read(workbook)).iter():
+                if _local(sheet.tag) != "sheet":
+                    continue
+                name = sheet.get("name")
+                rid = next(value for key, value in sheet.attrib.items()
+                           if _local(key) == "id")
+                part = relationships[rid][1]
+                self._parts[name] = _stamp(zf, part)
+                if reuse and previous._parts.get(name) == self._parts[name]:
+                    self.sheets[name] = previous.sheets[name]
+                    continue
+                if strings is None:
+                    strings = ([] if strings_part is None
+                               else SHARED_STRING.findall(zf.read(strings_part)))
+                self.sheets[name] = sheet_fingerprint(zf.read(part), strings)
+
+    def __repr__(self):
+        return f"WorkbookFingerprint({self.filepath!r}, sheets={len(self.sheets)})"
+
+    def changed(self, other) -> set:
+        """
+        Returns the names of the sheets that differ from another fingerprint of the
+        workbook, including sheets only one of them has.
+        :param other: WorkbookFingerprint
+        :return: set of str
+        """
+        return {name for name in self.sheets.keys() | other.sheets.keys()
+                if self.sheets.get(name) != other.sheets.get(name)}
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class WorkbookWatcher:
+    """
+    Watches a registry's workbook and the table list it came from (see
+    backend.import_tables) on a worker thread, by checking their size and
+    modification time every interval seconds. Once a change has settled, i.e. the
+    files look the same on two checks in a row, the sheets are fingerprinted (see
+    WorkbookFingerprint) and the registry is refreshed (see
+    backend.TableRegistry.refresh), so only the sheets that changed are read,
+    validated, and compiled again. The new registry is then swapped in as
+    registry, and on_change is called with (registry, changed), changed being the
+    set of names of the sheets that were edited, added, or removed. The registry
+    it replaced is left for its owner to close.
+    Files that cannot be read, e.g. because they are being saved, are tried again
+    at the next change.
+    """
+
+    def __init__(self, registry: backend.TableRegistry, tables_path, on_change=None,
+                 interval=POLL_INTERVAL):
+        self.registry = registry
+        self.tables_path = tables_path
+        self.on_change = on_change
+        self.interval = interval
+        self._files = self._file_states()
+        try:
+            self._fingerprint = WorkbookFingerprint(registry.filepath)
+        except (OSError, KeyError, StopIteration, ET.ParseError, zipfile.BadZipFile) as e:
+            # Every sheet counts as changed once the workbook can be read.
+            logger.warning("Could not read %s: %s", registry.filepath, e)
+            self._fingerprint = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="workbook watcher")
+
+    def __repr__(self):
+        return f"WorkbookWatcher({self.registry.filepath!r}, {self.tables_path!r})"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """
+        Stops watching. A refresh already under way is finished and reported.
+        :return: None
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _file_states(self) -> tuple:
+        return _file_state(self.registry.filepath), _file_state(self.tables_path)
+
+    def _run(self):
+        seen = self._files
+        while not self._cancelled.wait(self.interval):
+            files = self._file_states()
+            if files != seen:
+                # Possibly still being written; look again next time.
+                seen = files
+                continue
+            if files != self._files:
+                self._files = files
+                self.check()
+
+    def check(self):
+        """
+        Fingerprints the workbook and reads the table list now, and refreshes the
+        registry if anything changed since the last check.
+        :return: set of str, the sheets that changed, or None if the files could not
+            be read
+        """
+        filepath = self.registry.filepath
+        try:
+            tables = backend.import_tables(self.tables_path)
+            fingerprint = WorkbookFingerprint(filepath, self._fingerprint)
+        except Exception as e:
+            logger.warning("Could not read %s or %s: %s", filepath, self.tables_path, e)
+            return None
+        changed = set(tables) ^ set(self.registry.tables)
+        if self._fingerprint is None:
+            changed |= set(fingerprint.sheets) | set(tables)
+        else:
+            changed |= fingerprint.changed(self._fingerprint)
+        self._fingerprint = fingerprint
+        if not changed:
+            return changed
+        start = time.perf_counter()
+        self.registry = self.registry.refresh(tables, changed)
+        logger.info("Reloaded %s in %.3fs", ", ".join(sorted(changed)),
+                    time.perf_counter() - start)
+        if self.on_change is not None:
+            self.on_change(self.registry, changed)
+        return changed
+
+
+def watch_workbook(registry: backend.TableRegistry, tables_path, on_change=None,
+                   interval=POLL_INTERVAL) -> WorkbookWatcher:
+    """
+    This function starts watching a registry's workbook and table list for
+    changes (see WorkbookWatcher).
+    :param registry: backend.TableRegistry
+    :param tables_path: filepath of the table list
+    :param on_change: callable taking (registry, changed), or None
+    :param interval: float, seconds between checks
+    :return: WorkbookWatcher
+    """
+    return WorkbookWatcher(registry, tables_path, on_change, interval).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Validate a workbook's tables again every time it is saved.")
+    parser.add_argument("--workbook", default="./samples/encounters.xlsx")
+    parser.add_argument("--tables", default="./samples/tables.json",
+                        help="json file with the table list")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL,
+                        help="seconds between checks for changes")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parser.parse_args()
+
+    watched = backend.TableRegistry(backend.import_tables(args.tables), args.workbook)
+
+    def report(registry, changed):
+        global watched
+        watched.close()
+        watched = registry
+        names = [name for name in sorted(changed) if name in registry.tables]
+        failures = [registry.failure(name) for name in names
+                    if registry.failure(name) is not None]
+        for failure in failures:
+            print(failure)
+        print(f"{len(names) - len(failures)} of {len(names)} changed tables passed.")
+
+    for bad_table in watched.validate_all() or ():
+        print(bad_table)
+    watcher = watch_workbook(watched, args.tables, report, args.interval)
+    print(f"Watching {args.workbook} and {args.tables}; press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        watcher.cancel()
+    watcher.join()
+    watched.close()